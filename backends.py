@@ -0,0 +1,50 @@
+"""
+Hardware and cloud backends for the prepaid meter scripts.
+
+`load()` returns `(gpio, port, firebase)`. With `METER_BACKEND=pi` (the
+default) these are RPi.GPIO, the modem on /dev/ttyUSB0 and the live
+Firebase project through `firebase_rest.RestClient`. With
+`METER_BACKEND=sim` they are a `SimulatedGPIO` generating pulses on
+every configured input, a pty `FakeModem` and a local `FakeFirebase`
+seeded with `seed_data`, so the same script runs on any Linux box.
+
+Simulation knobs come from the environment: `SIM_PULSE_RATE`
+(pulses/s, default 1), `SIM_PULSE_JITTER` (fraction of the period,
+default 0.1) and `SIM_FIREBASE_DELAY` (seconds per request, default 0).
+"""
+import os
+
+MODEM_PORT = "/dev/ttyUSB0"
+MODEM_BAUD = 9600
+
+
+def load(firebase_url, meters, seed_data=None, kind=None):
+    kind = kind or os.environ.get("METER_BACKEND", "pi")
+    if kind == "pi":
+        import RPi.GPIO as gpio
+        import serial
+        from firebase_rest import RestClient
+
+        port = serial.Serial(MODEM_PORT, MODEM_BAUD, timeout=1)
+        return gpio, port, RestClient(firebase_url)
+
+    if kind != "sim":
+        raise ValueError("Unknown METER_BACKEND %r" % kind)
+
+    from fake_firebase import FakeFirebase
+    from firebase_rest import RestClient
+    from fake_modem import FakeModem
+    from sim_gpio import SimulatedGPIO
+
+    gpio = SimulatedGPIO()
+    rate = float(os.environ.get("SIM_PULSE_RATE", 1))
+    jitter = float(os.environ.get("SIM_PULSE_JITTER", 0.1))
+    for n, name in enumerate(sorted(meters)):
+        gpio.pulse_train(meters[name]["pin"], rate, jitter=jitter, seed=n)
+
+    modem = FakeModem()
+    modem.start()
+
+    cloud = FakeFirebase(seed_data, delay=float(os.environ.get("SIM_FIREBASE_DELAY", 0))).start()
+    print("Simulated Firebase at %s" % cloud.url)
+    return gpio, modem.open_port(), RestClient(cloud.url)
@@ -0,0 +1,79 @@
+"""
+Pulse analytics benchmark.
+
+Records `duration` seconds of pulses per meter at increasing rates into
+`PulseAnalytics` and times one `analyze()` over every meter's window,
+with NumPy and with the pure Python fallback. The ring holds the last
+`size` pulses, so once it is full the cost of a window should not grow
+with the pulse rate.
+
+    python benchmarks/bench_pulse_analytics.py
+    python benchmarks/bench_pulse_analytics.py --rates 1,100,10000 --meters 8 --size 4096
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pulse_analytics
+from pulse_analytics import PulseAnalytics
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def filled(vectorized, rate, meters, size, duration, now):
+    analytics = PulseAnalytics(meters, size=size, vectorized=vectorized)
+    r = random.Random(1)
+    pulses = int(rate * duration)
+    start = time.time()
+    for i in range(meters):
+        t = now - duration
+        stamps = []
+        for _ in range(pulses):
+            t += r.expovariate(rate)
+            stamps.append(t)
+        analytics.record_many(i, stamps)
+    recorded = time.time() - start
+    return analytics, recorded / max(pulses * meters, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rates", default="0.1,1,10,100,1000", help="comma separated pulses/s per meter")
+    parser.add_argument("--meters", type=int, default=4)
+    parser.add_argument("--size", type=int, default=pulse_analytics.RING_SIZE, help="pulses kept per meter")
+    parser.add_argument("--duration", type=float, default=600.0, help="seconds of pulses recorded")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    modes = [("numpy", True), ("python", False)]
+    if pulse_analytics.numpy is None:
+        print("numpy is not installed, timing the fallback only")
+        modes = modes[1:]
+
+    now = time.time()
+    print("%-8s %-8s %10s %10s %12s %12s %14s" % (
+        "mode", "rate/s", "recorded", "in window", "record us", "window ms", "per meter us"))
+    for rate in [float(r) for r in args.rates.split(",")]:
+        for name, vectorized in modes:
+            analytics, per_pulse = filled(vectorized, rate, args.meters, args.size, args.duration, now)
+            window = timed(lambda: analytics.analyze(now), args.repeat)
+            kept = analytics.analyze(now)[0]["pulses"]
+            print("%-8s %-8g %10d %10d %12.2f %12.3f %14.1f" % (
+                name, rate, int(rate * args.duration), kept, per_pulse * 1e6,
+                window * 1e3, window * 1e6 / args.meters))
+
+
+if __name__ == "__main__":
+    main()
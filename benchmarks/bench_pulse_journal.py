@@ -0,0 +1,98 @@
+"""
+Pulse journal throughput benchmark.
+
+Appends pulses to a `PulseJournal` for several fsync batch sizes and
+reports sustained pulses/s, append latency percentiles and fsyncs
+issued. Point `--dir` at the SD card to measure real storage, or use
+`--fsync-latency` to emulate a slow card (typical class 10 cards take
+5-20 ms per fsync) on any disk.
+
+    python benchmarks/bench_pulse_journal.py --pulses 20000 --dir /home/pi
+    python benchmarks/bench_pulse_journal.py --fsync-latency 10
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pulse_journal
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(directory, pulses, meters, fsync_every, ack_every):
+    path = os.path.join(directory, "bench_journal.bin")
+    for f in (path, path + ".ack"):
+        if os.path.exists(f):
+            os.remove(f)
+    journal = pulse_journal.PulseJournal(path, fsync_every=fsync_every, fsync_interval=1.0)
+    fsyncs = [0]
+    real_flush = journal.flush
+
+    def counting_flush():
+        if journal._pending:
+            fsyncs[0] += 1
+        real_flush()
+    journal.flush = counting_flush
+
+    latencies = []
+    start = time.time()
+    for n in range(pulses):
+        t = time.time()
+        seq = journal.append(n % meters, 1)
+        latencies.append(time.time() - t)
+        if ack_every and n % ack_every == ack_every - 1:
+            journal.flush()
+            journal.ack(seq)
+    journal.close()
+    elapsed = time.time() - start
+    return {
+        "rate": pulses / elapsed,
+        "p50": percentile(latencies, 50) * 1e6,
+        "p99": percentile(latencies, 99) * 1e6,
+        "max": max(latencies) * 1e6,
+        "fsyncs": fsyncs[0],
+        "size": os.path.getsize(path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--dir", help="directory to write the journal in (default: a temp dir)")
+    parser.add_argument("--pulses", type=int, default=20000)
+    parser.add_argument("--meters", type=int, default=8)
+    parser.add_argument("--batches", default="1,16,64,256", help="comma separated fsync_every values")
+    parser.add_argument("--ack-every", type=int, default=1000, help="acknowledge every N pulses (0: never)")
+    parser.add_argument("--fsync-latency", type=float, default=0.0, help="extra ms per fsync to emulate an SD card")
+    args = parser.parse_args()
+
+    if args.fsync_latency:
+        real_fsync = os.fsync
+
+        def slow_fsync(fd):
+            real_fsync(fd)
+            time.sleep(args.fsync_latency / 1000.0)
+        pulse_journal.os.fsync = slow_fsync
+
+    directory = args.dir or tempfile.mkdtemp(prefix="pulse_journal_")
+    try:
+        print("%-12s %12s %10s %10s %10s %8s %10s" % (
+            "fsync_every", "pulses/s", "p50 us", "p99 us", "max us", "fsyncs", "bytes"))
+        for batch in [int(b) for b in args.batches.split(",")]:
+            r = run(directory, args.pulses, args.meters, batch, args.ack_every)
+            print("%-12d %12.0f %10.1f %10.1f %10.1f %8d %10d" % (
+                batch, r["rate"], r["p50"], r["p99"], r["max"], r["fsyncs"], r["size"]))
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Pulse capture throughput benchmark for the prepaid meter loop.
+
+Drives `MeterEngine.run()` against a `SimulatedGPIO` pulse generator and
+a local `FakeFirebase`, then reports for each configuration the pulses
+generated vs captured, the pulse-to-cloud latency (from the simulated
+rising edge to the PATCH that carried it) and the CPU used by the
+process. No Pi, modem or network is needed.
+
+    python benchmarks/bench_pulse_throughput.py
+    python benchmarks/bench_pulse_throughput.py --rates 10,50,200 --meters 4 --delay 0.15
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fake_firebase import FakeFirebase
+from firebase_rest import RestClient
+from prepaid_meter import MeterEngine
+from pulse_journal import PulseJournal
+from sim_gpio import SimulatedGPIO
+
+
+class TimedEngine(MeterEngine):
+    """
+    Engine that remembers when each billed pulse was generated and
+    measures how long it took to reach the cloud.
+    """
+
+    def __init__(self, *args, **kwargs):
+        MeterEngine.__init__(self, *args, **kwargs)
+        self.pending = []
+        self.latencies = []
+
+    def bill(self, i, pulses=1, stamps=None):
+        train = self.gpio.trains.get(self.pins[i])
+        self.pending.append(train.current if train is not None else time.time())
+        MeterEngine.bill(self, i, pulses, stamps)
+
+    def sync(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        try:
+            synced = MeterEngine.sync(self)
+        except Exception:
+            with self.lock:
+                self.pending = pending + self.pending
+            raise
+        done = time.time()
+        self.latencies.extend(done - t for t in pending)
+        return synced
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(rate, meters, width, jitter, delay, duration, sync_interval, journal_dir):
+    names = ["m%02d" % i for i in range(meters)]
+    config = dict((n, {"pin": 100 + i, "led": 200 + i, "path": "/" + n}) for i, n in enumerate(names))
+    cloud = FakeFirebase(dict((n, {"Balance": 10 ** 9}) for n in names), delay=delay).start()
+    gpio = SimulatedGPIO()
+    journal = None
+    if journal_dir:
+        journal = PulseJournal(os.path.join(journal_dir, "bench_%d_%d.bin" % (rate, meters)))
+    engine = TimedEngine(config, gpio, RestClient(cloud.url), low_balance=0, journal=journal)
+    engine.setup()
+    engine.load()
+    for i, n in enumerate(names):
+        gpio.pulse_train(config[n]["pin"], rate, width=width, jitter=jitter, seed=i)
+
+    cpu = os.times()
+    start = time.time()
+    worker = threading.Thread(target=engine.run, kwargs={"sync_interval": sync_interval})
+    worker.start()
+    time.sleep(duration)
+    engine.stop()
+    worker.join()
+    generated = sum(gpio.generated(config[n]["pin"]) for n in names)
+    engine.sync()
+    wall = time.time() - start
+    cpu_end = os.times()
+    cloud.stop()
+
+    captured = sum((10 ** 9 - b) // engine.rate for b in engine.balances)
+    return {
+        "generated": generated,
+        "captured": captured,
+        "dropped": max(generated - captured, 0),
+        "p50": percentile(engine.latencies, 50) * 1000,
+        "p99": percentile(engine.latencies, 99) * 1000,
+        "cpu": 100.0 * ((cpu_end[0] - cpu[0]) + (cpu_end[1] - cpu[1])) / wall,
+        "requests": sum(cloud.requests.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rates", default="1,10,50,100", help="comma separated pulses/s per meter")
+    parser.add_argument("--meters", type=int, default=1)
+    parser.add_argument("--width", type=float, default=0.005, help="pulse width in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--delay", type=float, default=0.05, help="simulated Firebase round trip in seconds")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--sync-interval", type=float, default=1.0)
+    parser.add_argument("--journal", action="store_true", help="journal pulses to a temp dir")
+    args = parser.parse_args()
+
+    journal_dir = tempfile.mkdtemp(prefix="bench_pulse_") if args.journal else None
+    try:
+        print("%-8s %-7s %10s %10s %8s %10s %10s %7s %9s" % (
+            "rate/s", "meters", "generated", "captured", "dropped", "p50 ms", "p99 ms", "cpu %", "requests"))
+        for rate in [float(r) for r in args.rates.split(",")]:
+            r = run(rate, args.meters, args.width, args.jitter, args.delay,
+                    args.duration, args.sync_interval, journal_dir)
+            print("%-8g %-7d %10d %10d %8d %10.1f %10.1f %7.1f %9d" % (
+                rate, args.meters, r["generated"], r["captured"], r["dropped"],
+                r["p50"], r["p99"], r["cpu"], r["requests"]))
+    finally:
+        if journal_dir:
+            shutil.rmtree(journal_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+PUSH_ADDR event path load generator.
+
+Builds the frames `Remote.pushEvent()` sends (guest registration and
+de-registration, member/guest declaration, remote activity) and pushes
+them at fixed rates into a local `push_receiver.PushReceiver`, or into
+an already running receiver with `--address`. Reports achieved rate,
+send latency percentiles, frames dropped (sent but never received, or
+refused with EAGAIN under `--nonblocking`) and invalid frames.
+
+`--per-event-socket` sends the way `sendEvent()` used to, opening and
+connecting a new socket for every event, for comparison with the
+reused `remote_events.EventSender`.
+
+    python3 benchmarks/bench_push_events.py --rates 1000,10000,0
+    python3 benchmarks/bench_push_events.py --per-event-socket --nonblocking
+"""
+import argparse
+import errno
+import itertools
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import push_receiver
+import remote_events as events
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def frames():
+    """
+    Endless cycle of freshly encoded events in the mix a remote produces.
+    """
+    for n in itertools.count():
+        kind = n % 4
+        if kind == 0:
+            yield events.guest_reg(n % events.GUEST_KEYS, True, 18 + n % 60, n % 2 == 0)
+        elif kind == 1:
+            yield events.guest_reg(n % events.GUEST_KEYS, False, 18 + n % 60, n % 2 == 0)
+        elif kind == 2:
+            members = [bool(n >> k & 1) for k in range(events.MEMBER_KEYS)]
+            guests = [bool(n >> k & 1) for k in range(events.GUEST_KEYS)]
+            yield events.declaration(members, guests)
+        else:
+            yield events.remote_activity(n % 8 == 3)
+
+
+class PerEventSender():
+    """
+    The original `sendEvent()`: a new socket per datagram.
+    """
+
+    def __init__(self, address, nonblocking=False):
+        self.address = address
+        self.nonblocking = nonblocking
+
+    def send(self, body):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.address)
+            if self.nonblocking:
+                sock.setblocking(False)
+            sock.sendall(body)
+        finally:
+            sock.close()
+
+    def close(self):
+        pass
+
+
+def run(sender, receiver, rate, duration, nonblocking):
+    if nonblocking and isinstance(sender, events.EventSender):
+        sender.connect()
+        sender.sock.setblocking(False)
+    if receiver is not None:
+        receiver.reset()
+    latencies = []
+    sent = refused = 0
+    source = frames()
+    start = time.perf_counter()
+    end = start + duration
+    n = 0
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if rate:
+            due = start + n / rate
+            if due > now:
+                time.sleep(min(due - now, 0.001))
+                continue
+        body = next(source)
+        n += 1
+        t0 = time.perf_counter()
+        try:
+            sender.send(body)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            refused += 1
+            continue
+        latencies.append(time.perf_counter() - t0)
+        sent += 1
+    elapsed = time.perf_counter() - start
+    sender.close()
+
+    result = {"rate": rate or "max", "offered": n, "sent": sent, "refused": refused,
+              "achieved": sent / elapsed,
+              "p50_us": percentile(latencies, 50) * 1e6 if latencies else 0.0,
+              "p99_us": percentile(latencies, 99) * 1e6 if latencies else 0.0}
+    if receiver is not None:
+        receiver.wait_for(sent, timeout=2.0)
+        stats = receiver.stats()
+        result.update(received=stats["received"], invalid=stats["invalid"],
+                      dropped=n - stats["received"] - stats["invalid"])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--address", help="send to a running receiver instead of a local one")
+    parser.add_argument("--rates", default="1000,10000,0", help="comma separated events/s (0: as fast as possible)")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds per rate")
+    parser.add_argument("--rcvbuf", type=int, help="SO_RCVBUF for the local receiver")
+    parser.add_argument("--nonblocking", action="store_true", help="count EAGAIN as drops instead of blocking")
+    parser.add_argument("--per-event-socket", action="store_true", help="open a socket per event like the old sendEvent()")
+    args = parser.parse_args()
+
+    receiver = None
+    address = args.address
+    if address is None:
+        address = os.path.join(tempfile.mkdtemp(), "push.sock")
+        receiver = push_receiver.PushReceiver(address, rcvbuf=args.rcvbuf)
+        receiver.start()
+
+    print("%8s %9s %9s %9s %10s %8s %8s %9s %8s %8s" % (
+        "rate", "offered", "sent", "refused", "achieved", "p50 us", "p99 us", "received", "dropped", "invalid"))
+    try:
+        for rate in [float(r) for r in args.rates.split(",")]:
+            if args.per_event_socket:
+                sender = PerEventSender(address, args.nonblocking)
+            else:
+                sender = events.EventSender(address)
+            r = run(sender, receiver, rate, args.duration, args.nonblocking)
+            print("%8s %9d %9d %9d %10.0f %8.1f %8.1f %9s %8s %8s" % (
+                r["rate"], r["offered"], r["sent"], r["refused"], r["achieved"], r["p50_us"], r["p99_us"],
+                r.get("received", "-"), r.get("dropped", "-"), r.get("invalid", "-")))
+    finally:
+        if receiver is not None:
+            receiver.stop()
+            os.rmdir(os.path.dirname(address))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Legacy loop vs asyncio runtime benchmark.
+
+Runs the same meters against a `SimulatedGPIO` pulse generator and a
+local `FakeFirebase` twice: once with the blocking `MeterEngine.run()`
+loop the scripts used, where every cloud sync stalls pulse sampling,
+and once with `meter_runtime.MeterRuntime`. For each it reports pulses
+generated vs billed, end-to-end throughput (pulses billed and synced
+per second), pulse-to-cloud latency from the sampled edge to the PATCH
+that carried it, and the CPU used by the process.
+
+    python3 benchmarks/bench_runtime.py
+    python3 benchmarks/bench_runtime.py --rates 20,100 --meters 4 --delay 0.3
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fake_firebase import FakeFirebase
+from firebase_rest import RestClient
+from meter_runtime import MeterRuntime
+from prepaid_meter import MeterEngine
+from sim_gpio import SimulatedGPIO
+
+BALANCE = 10 ** 9
+
+
+class TimedEngine(MeterEngine):
+    """
+    Engine that measures how long each billed pulse took to reach the
+    cloud, from the time its edge was sampled.
+    """
+
+    def __init__(self, *args, **kwargs):
+        MeterEngine.__init__(self, *args, **kwargs)
+        self.pending = []
+        self.latencies = []
+
+    def bill(self, i, pulses=1, stamps=None):
+        with self.lock:
+            self.pending.extend(stamps or [time.time()] * pulses)
+        MeterEngine.bill(self, i, pulses, stamps)
+
+    def sync(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        try:
+            synced = MeterEngine.sync(self)
+        except Exception:
+            with self.lock:
+                self.pending = pending + self.pending
+            raise
+        done = time.time()
+        self.latencies.extend(done - t for t in pending)
+        return synced
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(mode, rate, meters, width, jitter, delay, duration, sync_interval):
+    names = ["m%02d" % i for i in range(meters)]
+    config = dict((n, {"pin": 100 + i, "led": 200 + i, "path": "/" + n}) for i, n in enumerate(names))
+    cloud = FakeFirebase(dict((n, {"Balance": BALANCE}) for n in names), delay=delay).start()
+    gpio = SimulatedGPIO()
+    engine = TimedEngine(config, gpio, RestClient(cloud.url), low_balance=0)
+    engine.setup()
+    engine.load()
+    for i, n in enumerate(names):
+        gpio.pulse_train(config[n]["pin"], rate, width=width, jitter=jitter, seed=i)
+
+    generated = []
+
+    def stop(target):
+        generated.append(sum(gpio.generated(config[n]["pin"]) for n in names))
+        target.stop()
+
+    cpu = os.times()
+    start = time.time()
+    if mode == "legacy":
+        timer = threading.Timer(duration, stop, [engine])
+        timer.start()
+        engine.run(sync_interval=sync_interval)
+        engine.sync()
+    else:
+        runtime = MeterRuntime(engine, sync_interval=sync_interval)
+        timer = threading.Timer(duration, stop, [runtime])
+        timer.start()
+        runtime.run()
+    wall = time.time() - start
+    cpu_end = os.times()
+    cloud.stop()
+
+    billed = sum((BALANCE - b) // engine.rate for b in engine.balances)
+    return {
+        "generated": generated[0],
+        "billed": billed,
+        "dropped": max(generated[0] - billed, 0),
+        "throughput": len(engine.latencies) / duration,
+        "p50": percentile(engine.latencies, 50) * 1000,
+        "p99": percentile(engine.latencies, 99) * 1000,
+        "cpu": 100.0 * ((cpu_end[0] - cpu[0]) + (cpu_end[1] - cpu[1])) / wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rates", default="10,50,100", help="comma separated pulses/s per meter")
+    parser.add_argument("--meters", type=int, default=2)
+    parser.add_argument("--width", type=float, default=0.005, help="pulse width in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--delay", type=float, default=0.2, help="simulated Firebase round trip in seconds")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--sync-interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    print("%-8s %-7s %-8s %10s %8s %8s %10s %9s %9s %7s" % (
+        "mode", "rate/s", "meters", "generated", "billed", "dropped", "synced/s", "p50 ms", "p99 ms", "cpu %"))
+    for rate in [float(r) for r in args.rates.split(",")]:
+        for mode in ("legacy", "asyncio"):
+            r = run(mode, rate, args.meters, args.width, args.jitter, args.delay,
+                    args.duration, args.sync_interval)
+            print("%-8s %-7g %-8d %10d %8d %8d %10.1f %9.1f %9.1f %7.1f" % (
+                mode, rate, args.meters, r["generated"], r["billed"], r["dropped"],
+                r["throughput"], r["p50"], r["p99"], r["cpu"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Tariff billing micro-benchmark.
+
+Bills batches of timestamped pulses with `Tariff.cost()` in one call and
+compares against billing the same pulses one at a time, which is what a
+per-pulse loop pays. Pulses are spread over a day so the batch crosses
+slab boundaries and time-of-day bands.
+
+    python benchmarks/bench_tariff.py
+    python benchmarks/bench_tariff.py --sizes 100,10000,100000 --span 86400
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tariff import Tariff, Thresholds
+
+TARIFF = {
+    "units_per_pulse": 1,
+    "slabs": [[0, 5], [100, 7], [300, 9], [500, 11]],
+    "tod": [["22:00", "06:00", 0.8], ["18:00", "22:00", 1.2]],
+    "thresholds": [500, 200, 100, 50, 20],
+}
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000", help="comma separated batch sizes")
+    parser.add_argument("--span", type=float, default=86400.0, help="seconds the batch is spread over")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    tariff = Tariff.from_config(TARIFF)
+    start = time.time() - args.span
+    print("%-10s %14s %14s %10s %12s" % ("pulses", "batch us", "per-pulse us", "speedup", "alerts us"))
+    for n in [int(x) for x in args.sizes.split(",")]:
+        stamps = [start + args.span * k / n for k in range(n)]
+
+        batch, total = timed(lambda: tariff.cost(0, n, stamps), args.repeat)
+
+        def one_by_one():
+            return sum(tariff.cost(k, 1, [ts]) for k, ts in enumerate(stamps))
+        single, check = timed(one_by_one, args.repeat)
+        assert abs(total - check) < 1e-6 * max(total, 1)
+
+        def alerts():
+            th = Thresholds(tariff.thresholds, 1)
+            balance = float(total)
+            step = total / n
+            for _ in range(n):
+                balance -= step
+                th.update(0, balance)
+        alert_time, _ = timed(alerts, args.repeat)
+
+        print("%-10d %14.1f %14.1f %9.1fx %12.1f" % (
+            n, batch * 1e6, single * 1e6, single / batch if batch else float("inf"), alert_time * 1e6))
+
+
+if __name__ == "__main__":
+    main()
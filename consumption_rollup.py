@@ -0,0 +1,138 @@
+"""
+Per-minute and per-hour consumption rollups.
+
+`Rollup` counts pulses per meter into two ring arrays: one slot per
+minute for the last `minutes` minutes and one per hour for the last
+`hours` hours. Each ring row is tagged with the epoch minute/hour it
+holds, so a slot is zeroed the first time it is reused.
+
+Buckets close when their minute or hour has passed. `pending()` returns
+every closed, not yet uploaded, non-empty bucket for all meters as one
+PATCH update (`MeterEngine.upload_history()` sends it), laid out as
+
+    <history path>/m/<epoch minute>: pulses
+    <history path>/h/<epoch hour>: pulses
+
+The rings and upload marks are saved to `path` whenever a minute
+closes, so history survives a restart.
+"""
+from array import array
+import json
+import os
+import struct
+import time
+
+HEADER = struct.Struct("<4sHHII")   # magic, meters, reserved, minutes, hours
+MAGIC = b"RLP1"
+
+
+class Ring(object):
+    """
+    `size` slots of per-meter counters tagged with their bucket number.
+    """
+
+    def __init__(self, meters, size, width):
+        self.meters = meters
+        self.size = size
+        self.width = width
+        self.keys = array("l", [-1] * size)
+        self.counts = array("H", [0] * (size * meters))
+
+    def add(self, bucket, i, count):
+        slot = bucket % self.size
+        if self.keys[slot] != bucket:
+            self.keys[slot] = bucket
+            base = slot * self.meters
+            for m in range(self.meters):
+                self.counts[base + m] = 0
+        k = slot * self.meters + i
+        self.counts[k] = min(self.counts[k] + count, 0xFFFF)
+
+    def closed(self, after, before):
+        """
+        (bucket, slot) for every bucket with after < bucket < before
+        still held in the ring, oldest first.
+        """
+        found = []
+        for slot in range(self.size):
+            bucket = self.keys[slot]
+            if after < bucket < before:
+                found.append((bucket, slot))
+        found.sort()
+        return found
+
+
+class Rollup(object):
+
+    def __init__(self, history_paths, path=None, minutes=1440, hours=168):
+        self.history_paths = history_paths
+        self.path = path
+        n = len(history_paths)
+        self.minute = Ring(n, minutes, 60)
+        self.hour = Ring(n, hours, 3600)
+        self.uploaded_minute = int(time.time()) // 60 - 1
+        self.uploaded_hour = int(time.time()) // 3600 - 1
+        self.current_minute = None
+        if path and os.path.exists(path):
+            self.load()
+
+    def add(self, i, ts, count=1):
+        minute = int(ts) // 60
+        if self.current_minute is not None and minute > self.current_minute:
+            self.save()
+        self.current_minute = max(minute, self.current_minute or minute)
+        self.minute.add(minute, i, count)
+        self.hour.add(int(ts) // 3600, i, count)
+
+    def pending(self, now=None):
+        """
+        The PATCH body for every closed, not yet uploaded bucket, and the
+        newest minute and hour it covers.
+        """
+        now = time.time() if now is None else now
+        update = {}
+        last = [self.uploaded_minute, self.uploaded_hour]
+        for k, (ring, tag, width) in enumerate(((self.minute, "m", 60), (self.hour, "h", 3600))):
+            for bucket, slot in ring.closed(last[k], int(now) // width):
+                base = slot * ring.meters
+                for i, hp in enumerate(self.history_paths):
+                    count = ring.counts[base + i]
+                    if count:
+                        update["%s/%s/%d" % (hp.strip("/"), tag, bucket)] = count
+                last[k] = bucket
+        return update, last[0], last[1]
+
+    def mark_uploaded(self, minute, hour):
+        self.uploaded_minute = minute
+        self.uploaded_hour = hour
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, self.minute.meters, 0, self.minute.size, self.hour.size))
+            marks = json.dumps([self.uploaded_minute, self.uploaded_hour]).encode("ascii")
+            f.write(struct.pack("<H", len(marks)) + marks)
+            for ring in (self.minute, self.hour):
+                ring.keys.tofile(f)
+                ring.counts.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            magic, meters, _, minutes, hours = HEADER.unpack(f.read(HEADER.size))
+            if (magic, meters, minutes, hours) != (MAGIC, self.minute.meters, self.minute.size, self.hour.size):
+                print("Ignoring rollup file %s with a different layout" % self.path)
+                return
+            size, = struct.unpack("<H", f.read(2))
+            self.uploaded_minute, self.uploaded_hour = json.loads(f.read(size).decode("ascii"))
+            for ring in (self.minute, self.hour):
+                keys = array("l")
+                keys.fromfile(f, ring.size)
+                counts = array("H")
+                counts.fromfile(f, ring.size * ring.meters)
+                ring.keys, ring.counts = keys, counts
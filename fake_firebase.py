@@ -0,0 +1,238 @@
+"""
+Local stand-in for the Firebase Realtime Database REST API.
+
+`FakeFirebase` serves GET/PUT/PATCH/POST/DELETE on `/<path>.json` from
+an in-memory JSON tree, including multi-path PATCH (`{"A/Balance": 1}`),
+so the meter can be pointed at `http://127.0.0.1:<port>` instead of a
+live project. `delay` adds a fixed round trip time and `down` makes
+every request fail with 503 to simulate an outage.
+
+A GET with `Accept: text/event-stream` is served as a Firebase stream:
+a `put` of the subtree first, then `put`/`patch` events for every write
+under it and a `keep-alive` every `keepalive` seconds.
+`drop_streams()` cuts all open streams to exercise reconnects.
+
+Point a `firebase_rest.RestClient` at `url` to use it.
+"""
+import json
+import threading
+import time
+
+from firebase_rest import split_path
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import queue
+from socketserver import ThreadingMixIn
+
+
+class Tree(object):
+    """
+    JSON tree addressed by slash separated paths.
+    """
+
+    def __init__(self, data=None):
+        self.data = data if data is not None else {}
+        self.lock = threading.Lock()
+
+    def get(self, parts):
+        node = self.data
+        for p in parts:
+            if not isinstance(node, dict) or p not in node:
+                return None
+            node = node[p]
+        return node
+
+    def set(self, parts, value):
+        if not parts:
+            self.data = value if value is not None else {}
+            return
+        node = self.data
+        for p in parts[:-1]:
+            child = node.get(p)
+            if not isinstance(child, dict):
+                child = node[p] = {}
+            node = child
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+
+    def update(self, parts, children):
+        for key, value in children.items():
+            self.set(parts + [k for k in key.split("/") if k], value)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length).decode("utf-8")) if length else None
+
+    def _stream(self, parts):
+        fb = self.server.firebase
+        events = queue.Queue()
+        with fb.tree.lock:
+            events.put(("put", {"path": "/", "data": fb.tree.get(parts)}))
+            fb.subscribe(parts, events)
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            while fb.streaming:
+                try:
+                    item = events.get(timeout=fb.keepalive)
+                except queue.Empty:
+                    item = ("keep-alive", None)
+                if item is None:
+                    break
+                event, data = item
+                msg = "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+                self.wfile.write(msg.encode("utf-8"))
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            fb.unsubscribe(events)
+
+    def _handle(self, method):
+        fb = self.server.firebase
+        body = self._body() if method in ("PUT", "PATCH", "POST") else None
+        if fb.delay:
+            time.sleep(fb.delay)
+        fb.count(method)
+        if fb.down:
+            self._reply(503, {"error": "service unavailable"})
+            return
+        parts = split_path(self.path)
+        if method == "GET" and "text/event-stream" in (self.headers.get("Accept") or ""):
+            self._stream(parts)
+            return
+        tree = fb.tree
+        with tree.lock:
+            if method == "GET":
+                result = tree.get(parts)
+            elif method == "PUT":
+                tree.set(parts, body)
+                result = body
+            elif method == "PATCH":
+                tree.update(parts, body or {})
+                result = body
+            elif method == "POST":
+                name = "-K%016d" % fb.next_push()
+                tree.set(parts + [name], body)
+                result = {"name": name}
+            else:
+                tree.set(parts, None)
+                result = None
+            fb.changed(method, parts, body)
+        self._reply(200, result)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeFirebase(object):
+
+    handler = Handler
+
+    def __init__(self, data=None, host="127.0.0.1", port=0, delay=0.0, keepalive=30.0):
+        self.tree = Tree(data)
+        self.delay = delay
+        self.keepalive = keepalive
+        self.down = False
+        self.streaming = True
+        self.subscribers = []
+        self.requests = {}
+        self._push = 0
+        self._lock = threading.Lock()
+        self.server = _Server((host, port), self.handler)
+        self.server.firebase = self
+        self.url = "http://%s:%d" % self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.streaming = False
+        self.drop_streams()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def subscribe(self, parts, events):
+        with self._lock:
+            self.subscribers.append((parts, events))
+
+    def unsubscribe(self, events):
+        with self._lock:
+            self.subscribers = [s for s in self.subscribers if s[1] is not events]
+
+    def drop_streams(self):
+        with self._lock:
+            for _, events in self.subscribers:
+                events.put(None)
+
+    def count(self, method):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def next_push(self):
+        with self._lock:
+            self._push += 1
+            return self._push
+
+    def changed(self, method, parts, body):
+        """
+        Forward a write to every stream whose subtree it touches. Called
+        with the tree lock held so events keep the write order.
+        """
+        if method == "GET":
+            return
+        if method == "POST":
+            method, body = "PUT", self.tree.get(parts)
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for sub, events in subscribers:
+            if parts[:len(sub)] == sub:
+                rel = "/" + "/".join(parts[len(sub):])
+                if method == "PATCH":
+                    events.put(("patch", {"path": rel, "data": body}))
+                else:
+                    events.put(("put", {"path": rel, "data": body}))
+            elif sub[:len(parts)] == parts:
+                events.put(("put", {"path": "/", "data": self.tree.get(sub)}))
@@ -0,0 +1,171 @@
+"""
+pty-backed stand-in for the GSM modem.
+
+`FakeModem` answers the AT subset the meter uses (AT, ATE, AT+CMGF,
+AT+CNMI, AT+CMGS, AT+CMGR, AT+CMGL, AT+CMGD) on the master side of a
+pseudo terminal. Open `FakeModem.port_name` like /dev/ttyUSB0, or use
+`FakeModem.open_port()` for a raw file object that `gsm_modem.Modem`
+accepts directly.
+
+    fm = FakeModem(delay=0.05)
+    fm.start()
+    modem = gsm_modem.Modem(fm.open_port())
+    modem.init()
+    fm.inject_sms("+919665916383", "*#*#100#*#*")   # emits +CMTI
+"""
+import os
+import threading
+import time
+import tty
+
+
+class FakeModem(threading.Thread):
+
+    def __init__(self, delay=0.0, echo=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.delay = delay
+        self.echo = echo
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        self.lock = threading.Lock()
+        self.inbox = {}
+        self.next_index = 1
+        self.sent = []
+        self.commands = []
+        self.fail_next = []
+        self.silent_next = 0
+        self.running = True
+        self._pending_sms = None
+
+    def open_port(self):
+        return os.fdopen(os.dup(self.slave), "r+b", 0)
+
+    def _send(self, text):
+        data = text.encode("latin-1") if not isinstance(text, bytes) else text
+        os.write(self.master, data)
+
+    def _reply(self, *lines):
+        if self.delay:
+            time.sleep(self.delay)
+        self._send("".join("\r\n%s\r\n" % l for l in lines))
+
+    def urc(self, line):
+        self._send("\r\n%s\r\n" % line)
+
+    def inject_sms(self, sender, text, notify=True):
+        """
+        Store an incoming SMS and, unless `notify` is False, announce it
+        with a +CMTI URC. Returns the storage index.
+        """
+        with self.lock:
+            index = self.next_index
+            self.next_index += 1
+            self.inbox[index] = {
+                "sender": sender,
+                "text": text,
+                "status": "REC UNREAD",
+                "stamp": time.strftime("%y/%m/%d,%H:%M:%S+22"),
+            }
+        if notify:
+            self.urc('+CMTI: "SM",%d' % index)
+        return index
+
+    def _format_sms(self, index, msg):
+        return '+CMGR: "%s","%s","","%s"' % (msg["status"], msg["sender"], msg["stamp"])
+
+    def handle(self, cmd):
+        self.commands.append(cmd)
+        if self.silent_next:
+            self.silent_next -= 1
+            return
+        if self.fail_next:
+            self._reply(self.fail_next.pop(0))
+            return
+        upper = cmd.upper()
+        if upper.startswith("ATE"):
+            self.echo = upper.endswith("1")
+            self._reply("OK")
+        elif upper.startswith("AT+CMGS="):
+            self._pending_sms = cmd.split("=", 1)[1].strip('"')
+            if self.delay:
+                time.sleep(self.delay)
+            self._send("\r\n> ")
+        elif upper.startswith("AT+CMGR="):
+            index = int(cmd.split("=", 1)[1])
+            with self.lock:
+                msg = self.inbox.get(index)
+                if msg is not None:
+                    text = msg["text"]
+                    line = self._format_sms(index, msg)
+                    msg["status"] = "REC READ"
+            if msg is None:
+                self._reply("OK")
+            else:
+                self._reply(line + "\r\n" + text, "OK")
+        elif upper.startswith("AT+CMGL"):
+            with self.lock:
+                rows = []
+                for index in sorted(self.inbox):
+                    msg = self.inbox[index]
+                    rows.append('+CMGL: %d,"%s","%s","","%s"\r\n%s' % (
+                        index, msg["status"], msg["sender"], msg["stamp"], msg["text"]))
+                    msg["status"] = "REC READ"
+            self._reply(*(rows + ["OK"]))
+        elif upper.startswith("AT+CMGD="):
+            index = int(cmd.split("=", 1)[1].split(",")[0])
+            with self.lock:
+                self.inbox.pop(index, None)
+            self._reply("OK")
+        elif upper.startswith("AT"):
+            self._reply("OK")
+        else:
+            self._reply("ERROR")
+
+    def _finish_sms(self, text):
+        self.sent.append((self._pending_sms, text))
+        self._pending_sms = None
+        self._reply("+CMGS: %d" % len(self.sent), "OK")
+
+    def run(self):
+        buf = b""
+        while self.running:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            if not data:
+                break
+            if self.echo:
+                os.write(self.master, data)
+            buf += data
+            while True:
+                if self._pending_sms is not None:
+                    end = buf.find(b"\x1a")
+                    esc = buf.find(b"\x1b")
+                    if esc != -1 and (end == -1 or esc < end):
+                        self._pending_sms = None
+                        buf = buf[esc + 1:]
+                        self._reply("OK")
+                        continue
+                    if end == -1:
+                        break
+                    self._finish_sms(buf[:end].decode("latin-1"))
+                    buf = buf[end + 1:]
+                    continue
+                end = buf.find(b"\r")
+                if end == -1:
+                    break
+                cmd = buf[:end].decode("latin-1").strip()
+                buf = buf[end + 1:]
+                if cmd:
+                    self.handle(cmd)
+
+    def stop(self):
+        self.running = False
+        for fd in (self.slave, self.master):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
@@ -1,103 +1,64 @@
-import time
-from firebase import firebase
-import RPi.GPIO  as g
-import serial
-
-g.setmode(g.BOARD)
-g.setup(38, g.IN, pull_up_down=g.PUD_DOWN)
-g.setup(40,g.OUT)
-
-sent= False
-#balance1= 200
-#reading1= 40
-#prev_balance=200
-
-port= serial.Serial("/dev/ttyUSB0",9600,timeout= 1)
-
-firebase=firebase.FirebaseApplication('https://prepaidm123.firebaseio.com', None)
-
-balance1 = firebase.get('/Master/Balance',None)
-reading1 = balance1/5					#firebase.get('/reading1',None)
+import backends
+from gsm_modem import Modem
+from sms_outbox import Outbox
+from recharge_sms import RechargeIngester
+from prepaid_meter import MeterEngine
+from tariff import Tariff
+from pulse_journal import PulseJournal
+from pulse_analytics import PulseAnalytics
+from firebase_stream import BalanceStream
+from meter_runtime import MeterRuntime
+from meter_metrics import StatsWriter
+
+METERS = {
+    "Master": {"pin": 38, "led": 40, "pull": "down", "path": "/Master", "phone": "9503436450"},
+}
+
+# Rupees per unit by monthly slab, time-of-day multipliers and low balance alerts
+TARIFF = {
+    "units_per_pulse": 1,
+    "slabs": [[0, 5]],
+    "tod": [],
+    "thresholds": [50],
+}
+
+stats= StatsWriter("meter_stats.json", interval=10)
+stats.start()
+
+g, port, firebase = backends.load('https://prepaidm123.firebaseio.com', METERS,
+                                  seed_data={"Master": {"Balance": 200}})
+modem= Modem(port, verbose=True)
 
 def gsm_init():
-	port.write('AT'+'\r')
-	rcv = port.readline()
-	print rcv
-	time.sleep(1)
- 
-	port.write('ATE0'+'\r')      # Disable the Echo
-	rcv = port.readline()
-	print rcv
-	time.sleep(1)
- 
-	port.write('AT+CMGF=1'+'\r')  # Select Message format as Text mode 
-	rcv = port.readline()
-	print rcv
-	time.sleep(1)
- 
-	port.write('AT+CNMI=2,1,0,0,0'+'\r')   # New SMS Message Indications
-	rcv = port.readline()
-	print rcv
-	time.sleep(1)
+    modem.init()
 
 gsm_init()
 
-def send_sms():
-
-	global sent
-	port.write('AT+CMGS= "9503436450"'+'\r')
-	rcv = port.readline()
-	print rcv
-	time.sleep(1)
-	#print "hell"
-	port.write('Hello User'+'\r')  # Message
-	rcv = port.readline()
-	print rcv
-
-	port.write("\x1A") # Enable to send SMS
-	sent= True
-	print 'SMS sent...'
-
+def sms_status(msg):
+    print('SMS %d to %s %s' % (msg["id"], msg["number"], msg["status"]))
 
-def firebase_update():
+outbox= Outbox(modem, path="sms_outbox.json", on_status=sms_status)
 
-    global balance1 ,reading1
-    firebase.put('','/Master/Balance',balance1)
-    firebase.put('','/Master/MeterReading',reading1)
+def send_sms(name, balance, threshold):
+    outbox.enqueue(METERS[name]["phone"], 'Hello User', key="low_balance:" + name)
 
-def read_pulse():
+journal= PulseJournal("pulse_journal.bin")
+meters= MeterEngine(METERS, g, firebase, tariff=Tariff.from_config(TARIFF), on_low_balance=send_sms, journal=journal,
+                    rollup_path="consumption_rollup.bin", analytics=PulseAnalytics(len(METERS)))
+meters.setup()
+meters.load()
 
-    global balance1, reading1, sent
-    if g.input(38):
-        
-	balance1 = firebase.get('/Master/Balance',None)
-	
-        balance1 = balance1 - 5
-        reading1 = reading1 - 1
-        
-	
-        firebase_update()
-        
-        g.output(40,True)
-        time.sleep(0.3)
-        g.output(40,False)
+stream= BalanceStream(firebase.dsn, meters)
 
-	if balance1 > 50:
-		sent= False
-        
-        while g.input(38):
-            reading1=reading1
-        
-        
-while True:
-    try:
+def recharge(value, sender):
+    i = meters.meter_for_phone(sender)
+    if i is None:
+        print('Recharge from unknown number %s ignored' % sender)
+        return
+    print('Recharge from %s: %d' % (sender, value))
+    meters.set_balance(i, value)
 
-        read_pulse()
+recharger= RechargeIngester(modem, recharge, path="recharge_applied.json", allowed_senders=meters.phones())
 
-	if sent== False and balance1 < 50:
-		send_sms()
-	
-        
-    except IOError:
-        
-        print "exited successfully"
+runtime= MeterRuntime(meters, modem=modem, outbox=outbox, ingester=recharger, stream=stream)
+runtime.run()
@@ -0,0 +1,83 @@
+"""
+REST client for the Firebase Realtime Database.
+
+`RestClient` has the `get`/`put`/`patch`/`post`/`delete` signatures of
+`firebase.FirebaseApplication` (python-firebase, which does not import
+on Python 3.7+) and the `dsn` that `firebase_stream.BalanceStream`
+needs. It keeps one http or https connection alive across requests and
+reconnects once when the server dropped it. Every failure, including
+HTTP protocol errors and bodies that are not JSON, is raised as IOError.
+"""
+from http.client import HTTPConnection, HTTPSConnection
+import json
+import threading
+from urllib.parse import urlencode, urlparse
+
+
+def split_path(path):
+    path = urlparse(path).path
+    if path.endswith(".json"):
+        path = path[:-len(".json")]
+    return [p for p in path.split("/") if p]
+
+
+class RestClient(object):
+    """
+    Keep-alive REST client mirroring `firebase.FirebaseApplication`.
+    `authentication` is a database secret or ID token sent as `auth`.
+    """
+
+    def __init__(self, dsn, authentication=None, timeout=10):
+        self.dsn = dsn
+        self.query = "?" + urlencode({"auth": authentication}) if authentication else ""
+        parsed = urlparse(dsn)
+        self.host = parsed.netloc
+        self.connection = HTTPSConnection if parsed.scheme == "https" else HTTPConnection
+        self.timeout = timeout
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _request(self, method, url, data=None):
+        path = "/" + "/".join(split_path(url)) + ".json" + self.query
+        body = json.dumps(data) if data is not None or method in ("PUT", "PATCH", "POST") else None
+        with self.lock:
+            for attempt in (0, 1):
+                if self.conn is None:
+                    self.conn = self.connection(self.host, timeout=self.timeout)
+                try:
+                    self.conn.request(method, path, body, {"Content-Type": "application/json"})
+                    resp = self.conn.getresponse()
+                    payload = resp.read()
+                    break
+                except Exception as e:
+                    self.conn.close()
+                    self.conn = None
+                    if attempt:
+                        if isinstance(e, OSError):
+                            raise
+                        raise IOError("%s %s failed: %r" % (method, path, e)) from e
+        if resp.status >= 400:
+            raise IOError("%s %s -> HTTP %d" % (method, path, resp.status))
+        try:
+            return json.loads(payload.decode("utf-8")) if payload else None
+        except ValueError as e:
+            raise IOError("%s %s returned a body that is not JSON: %s" % (method, path, e)) from e
+
+    @staticmethod
+    def _url(url, name):
+        return url.rstrip("/") + "/" + name.strip("/") if name else url
+
+    def get(self, url, name, params=None):
+        return self._request("GET", self._url(url, name))
+
+    def put(self, url, name, data, params=None):
+        return self._request("PUT", self._url(url, name), data)
+
+    def patch(self, url, data, params=None):
+        return self._request("PATCH", url, data)
+
+    def post(self, url, data, params=None):
+        return self._request("POST", url, data)
+
+    def delete(self, url, name, params=None):
+        return self._request("DELETE", self._url(url, name))
@@ -0,0 +1,133 @@
+"""
+Realtime listener for balance changes made outside the meter.
+
+`BalanceStream` holds one server-sent-events connection to the Firebase
+REST streaming API on the engine's common root (`GET <root>.json` with
+`Accept: text/event-stream`) and feeds every `put`/`patch` event to
+`MeterEngine.apply_remote()`. While the stream is up the engine skips
+its read-before-write GET, so pulse handling and syncing never wait on
+a read round trip.
+
+Firebase has no event ids to resume from; instead the first event on
+every connection is a `put` of the whole subtree, which the engine
+merges like any other change. Dropped connections are retried with
+exponential backoff, and the engine falls back to polling in `sync()`
+until the stream is back.
+"""
+import json
+import socket
+import threading
+import time
+
+from meter_metrics import METRICS
+
+from urllib.request import Request, urlopen
+
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 60.0
+# Firebase sends keep-alive events every 30 s.
+READ_TIMEOUT = 75
+
+
+def parse_events(lines):
+    """
+    Turn an iterable of SSE lines into (event, data) pairs.
+    """
+    event = None
+    data = []
+    for line in lines:
+        if not isinstance(line, str):
+            line = line.decode("utf-8")
+        line = line.rstrip("\r\n")
+        if not line:
+            if event is not None or data:
+                yield event, "\n".join(data)
+            event = None
+            data = []
+        elif line.startswith(":"):
+            continue
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+
+
+def _socket(resp):
+    """
+    The socket under a streaming response, or None.
+    """
+    # The body is a BufferedReader over a SocketIO.
+    return getattr(getattr(getattr(resp, "fp", None), "raw", None), "_sock", None)
+
+
+class BalanceStream(threading.Thread):
+
+    def __init__(self, url, engine, auth=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url.rstrip("/") + "/" + engine.root.strip("/") + ".json"
+        if auth:
+            self.url += "?auth=" + auth
+        self.engine = engine
+        self.running = True
+        self.connected = False
+        self.events = 0
+        self.reconnects = 0
+        self.resp = None
+        METRICS.gauge("stream.connected", lambda: int(self.connected))
+        METRICS.gauge("stream.events", lambda: self.events)
+        METRICS.gauge("stream.reconnects", lambda: self.reconnects)
+
+    def handle(self, event, data):
+        if event in ("put", "patch"):
+            payload = json.loads(data)
+            self.engine.apply_remote(payload["path"], payload["data"], patch=event == "patch")
+            self.events += 1
+        elif event in ("cancel", "auth_revoked"):
+            raise IOError("stream %s: %s" % (event, data))
+
+    def listen(self):
+        req = Request(self.url, headers={"Accept": "text/event-stream"})
+        self.resp = urlopen(req, timeout=READ_TIMEOUT)
+        try:
+            self.connected = True
+            self.engine.streaming = True
+            for event, data in parse_events(iter(self.resp.readline, b"")):
+                if not self.running:
+                    break
+                self.handle(event, data)
+        finally:
+            self.connected = False
+            self.engine.streaming = False
+            self.resp.close()
+
+    def run(self):
+        delay = RECONNECT_MIN
+        while self.running:
+            started = time.time()
+            try:
+                self.listen()
+            except Exception as e:
+                if self.running:
+                    print("Balance stream dropped: %s" % e)
+            if not self.running:
+                break
+            if time.time() - started > RECONNECT_MAX:
+                delay = RECONNECT_MIN
+            self.reconnects += 1
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def stop(self):
+        """
+        Stop listening. The blocked read is woken by shutting the
+        socket down; closing the buffered response would wait on its
+        lock until the next keep-alive.
+        """
+        self.running = False
+        sock = _socket(self.resp)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
@@ -0,0 +1,257 @@
+"""
+Response-driven driver for the SIM800/SIM900 style GSM modem on the
+prepaid meter.
+
+Every AT command is written once and the reply is parsed line by line
+until a final result code (OK, ERROR, +CME ERROR, +CMS ERROR) or the
+`>` text prompt arrives, so a command returns as soon as the modem
+answers instead of after a fixed sleep. Reply times are recorded per
+command as `modem.<command>` in `meter_metrics.METRICS`. Each command has its own
+timeout. Unsolicited result codes (+CMTI, RING, ...) that show up while
+a command is running, or between commands, are kept in `Modem.urcs`
+for the caller to consume.
+
+The port only needs `fileno()` and `write()`, so a pyserial `Serial`
+and a pty opened with `fake_modem.FakeModem` both work.
+"""
+import collections
+import os
+import select
+import threading
+import time
+
+from meter_metrics import METRICS
+
+_now = getattr(time, "monotonic", time.time)
+
+CTRL_Z = b"\x1a"
+ESC = b"\x1b"
+
+FINAL_OK = ("OK",)
+FINAL_ERROR = ("ERROR", "NO CARRIER", "NO ANSWER", "BUSY", "NO DIALTONE")
+FINAL_ERROR_PREFIXES = ("+CME ERROR:", "+CMS ERROR:")
+
+# Unsolicited result codes the meter cares about, matched by prefix.
+URC_PREFIXES = (
+    "+CMTI:", "+CMT:", "+CDS:", "+CDSI:", "+CLIP:", "+CUSD:", "+CPIN:",
+    "+CFUN:", "RING", "Call Ready", "SMS Ready", "RDY", "UNDER-VOLTAGE",
+    "OVER-VOLTAGE", "NORMAL POWER DOWN",
+)
+
+DEFAULT_TIMEOUT = 2.0
+# Worst case reply times from the SIM800 AT command manual.
+COMMAND_TIMEOUTS = {
+    "AT+CMGS": 60.0,
+    "AT+CMGR": 5.0,
+    "AT+CMGD": 5.0,
+    "AT+CMGL": 20.0,
+    "AT+COPS": 120.0,
+    "AT+CUSD": 10.0,
+}
+
+INIT_COMMANDS = (
+    "ATE0",                 # Disable the Echo
+    "AT+CMGF=1",            # Select Message format as Text mode
+    "AT+CNMI=2,1,0,0,0",    # New SMS Message Indications
+)
+
+
+class ModemError(IOError):
+    """
+    The modem answered a command with an error result code.
+    """
+
+    def __init__(self, command, code, lines=None):
+        IOError.__init__(self, "%s -> %s" % (command, code))
+        self.command = command
+        self.code = code
+        self.lines = lines or []
+
+
+class ModemTimeout(ModemError):
+    """
+    No final result code arrived within the command's timeout.
+    """
+
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode("latin-1")
+
+
+def command_timeout(cmd):
+    """
+    Timeout for `cmd`, looked up by the command name before `=`/`?`.
+    """
+    name = cmd.split("=", 1)[0].split("?", 1)[0].strip().upper()
+    return COMMAND_TIMEOUTS.get(name, DEFAULT_TIMEOUT)
+
+
+def is_urc(line):
+    return line.startswith(URC_PREFIXES)
+
+
+class Modem(object):
+
+    def __init__(self, port, verbose=False):
+        self.port = port
+        self.fd = port.fileno()
+        self.verbose = verbose
+        self.urcs = collections.deque()
+        self.lock = threading.RLock()
+        self._buf = bytearray()
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def _write(self, data):
+        self.port.write(_to_bytes(data))
+        flush = getattr(self.port, "flush", None)
+        if flush:
+            flush()
+
+    def _fill(self, timeout):
+        """
+        Wait up to `timeout` seconds for bytes from the modem and append
+        them to the buffer. Returns False if nothing arrived.
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not ready:
+            return False
+        data = os.read(self.fd, 1024)
+        if not data:
+            raise IOError("modem port closed")
+        self._buf.extend(data)
+        return True
+
+    def _next_line(self, deadline, prompt=False):
+        """
+        Next non-empty line from the modem, or `">"` when `prompt` is set
+        and the SMS text prompt is waiting. None once `deadline` passes.
+        """
+        while True:
+            while True:
+                stripped = self._buf.lstrip(b"\r\n")
+                if len(stripped) != len(self._buf):
+                    del self._buf[:len(self._buf) - len(stripped)]
+                if prompt and self._buf.startswith(b">"):
+                    del self._buf[:2 if self._buf.startswith(b"> ") else 1]
+                    return ">"
+                end = self._buf.find(b"\n")
+                cr = self._buf.find(b"\r")
+                if cr != -1 and (end == -1 or cr < end):
+                    end = cr
+                if end == -1:
+                    break
+                line = bytes(self._buf[:end]).decode("latin-1").strip()
+                del self._buf[:end + 1]
+                if line:
+                    return line
+            remaining = deadline - _now()
+            if remaining <= 0 or not self._fill(remaining):
+                if _now() >= deadline:
+                    return None
+
+    def _collect(self, cmd, deadline, prompt=False):
+        """
+        Read reply lines for `cmd` until a final result code. URCs are
+        diverted to `self.urcs`; an echo of the command is dropped.
+        """
+        lines = []
+        while True:
+            line = self._next_line(deadline, prompt)
+            if line is None:
+                METRICS.incr("modem.timeouts")
+                raise ModemTimeout(cmd, "TIMEOUT", lines)
+            if line == ">":
+                return lines, ">"
+            if line == cmd.strip():
+                continue
+            if line in FINAL_OK:
+                return lines, line
+            if line in FINAL_ERROR or line.startswith(FINAL_ERROR_PREFIXES):
+                raise ModemError(cmd, line, lines)
+            # A URC never carries the prefix of the command being answered.
+            name = cmd.split("=", 1)[0][2:]
+            if is_urc(line) and not (name and line.startswith(name + ":")):
+                self.urcs.append(line)
+                continue
+            lines.append(line)
+
+    def command(self, cmd, timeout=None, prompt=False):
+        """
+        Send `cmd` and return its information response lines.
+
+        Raises `ModemError` on an error result code and `ModemTimeout`
+        when the modem stays silent past the per-command timeout.
+        """
+        if timeout is None:
+            timeout = command_timeout(cmd)
+        with self.lock:
+            self.poll()
+            self._log(cmd)
+            self._write(cmd + "\r")
+            with METRICS.timed("modem." + cmd.split("=", 1)[0].split('"', 1)[0]):
+                lines, final = self._collect(cmd, _now() + timeout, prompt)
+            self._log(lines + [final])
+            return lines
+
+    def poll(self, timeout=0):
+        """
+        Drain whatever the modem sent outside a command into `self.urcs`.
+        Returns the number of URCs now queued.
+        """
+        if timeout:
+            # Wait outside the lock so a command on another thread can run.
+            select.select([self.fd], [], [], timeout)
+        with self.lock:
+            while self._fill(0):
+                pass
+            while True:
+                line = self._next_line(_now())
+                if line is None:
+                    break
+                if line not in FINAL_OK:
+                    self.urcs.append(line)
+        return len(self.urcs)
+
+    def init(self, retries=3):
+        """
+        Bring the modem to a known state: echo off, SMS text mode and
+        new-message indications routed to +CMTI.
+        """
+        for attempt in range(retries):
+            try:
+                self.command("AT", timeout=1.0)
+                break
+            except ModemTimeout:
+                if attempt == retries - 1:
+                    raise
+        for cmd in INIT_COMMANDS:
+            self.command(cmd)
+
+    def send_sms(self, number, text, timeout=None):
+        """
+        Send a text-mode SMS and return the message reference reported
+        in `+CMGS:`.
+        """
+        cmd = 'AT+CMGS="%s"' % number
+        if timeout is None:
+            timeout = command_timeout(cmd)
+        with self.lock:
+            try:
+                self.command(cmd, timeout=DEFAULT_TIMEOUT * 2, prompt=True)
+                self._write(_to_bytes(text) + CTRL_Z)
+                with METRICS.timed("modem.sms_submit"):
+                    lines, _ = self._collect(cmd, _now() + timeout)
+            except ModemTimeout:
+                # A late `>` prompt leaves the modem in text entry, where
+                # it would take the next commands as message body.
+                self._write(ESC)
+                raise
+        for line in lines:
+            if line.startswith("+CMGS:"):
+                return int(line.split(":", 1)[1])
+        return None
@@ -0,0 +1,97 @@
+"""
+Registered member configuration with change detection.
+
+`MemberConfig.refresh()` reloads MEMBER_INFO only when it changed. With
+a `path` to the file behind `get_config` (MEMBER_CONFIG_PATH), a change
+is detected with one stat() and nothing is forked while it stays the
+same; otherwise `get_config MEMBER_INFO` is run and its output is only
+parsed when it differs from the last one.
+
+The registered members are kept precomputed as a frozenset of letters
+("A" for position 1) and as a bitmask, so membership checks are
+constant time.
+"""
+import json
+import os
+import subprocess
+
+MEMBER_INFO_COMMAND = "get_config MEMBER_INFO"
+MAX_MEMBERS = 12
+
+
+def default_members():
+    """
+    Members assumed during installation mode when none are configured.
+    """
+    return [chr(65+i) for i in range(MAX_MEMBERS)]
+
+
+def parse_member_info(raw: str) -> list:
+    """
+    Member letters for a MEMBER_INFO JSON object keyed "M<position>".
+    """
+    if not raw:
+        return []
+    member_info = json.loads(raw)
+    if not member_info:
+        return []
+    return [chr(64+p) for p in sorted(int(k[1:]) for k in member_info.keys())]
+
+
+class MemberConfig():
+
+    def __init__(self, path: str=None, command: str=MEMBER_INFO_COMMAND):
+        self.path = path
+        self.command = command
+        self.stamp = None
+        self.raw = None
+        self.configured = []
+        self.installation_mode = None
+        self.members = frozenset()
+        self.ordered = []
+        self.mask = 0
+        self.reloads = 0
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _read(self):
+        if self.path is not None:
+            stamp = self._stamp()
+            if stamp is not None and stamp == self.stamp:
+                return self.raw
+            self.stamp = stamp
+        return subprocess.getoutput(self.command)
+
+    def refresh(self, installation_mode: bool=False) -> bool:
+        """
+        Reload the configuration if its source changed. Returns True if
+        the registered members changed.
+        """
+        raw = self._read()
+        if raw != self.raw:
+            self.raw = raw
+            self.configured = parse_member_info(raw)
+            self.reloads += 1
+        elif installation_mode == self.installation_mode:
+            return False
+        self.installation_mode = installation_mode
+
+        ordered = self.configured
+        if not ordered and installation_mode:
+            ordered = default_members()
+        if ordered == self.ordered:
+            return False
+        self.ordered = ordered
+        self.members = frozenset(ordered)
+        self.mask = 0
+        for m in ordered:
+            self.mask |= 1 << (ord(m) - 65)
+        return True
+
+    def __contains__(self, member):
+        return member in self.members
@@ -0,0 +1,190 @@
+"""
+Latency and health metrics for the meter process.
+
+`METRICS` is the process wide registry. Code records into it with
+
+    METRICS.observe("pulse.ledger", seconds)    # latency histogram
+    METRICS.incr("sms.failed")                  # counter
+    METRICS.gauge("sms.outbox", outbox_len)     # value or callable
+    with METRICS.timed("firebase.patch"):       # histogram + ".errors"
+        ...
+
+Histograms are fixed log2 buckets from 100 us to ~100 s held in an
+`array`, so an observation is one bisect and a few integer updates and
+memory does not grow with traffic. Callable gauges (queue depths and
+the like) are only evaluated when a snapshot is taken.
+
+`StatsWriter` writes `snapshot()` as JSON to a file every `interval`
+seconds with an atomic rename, e.g. `meter_stats.json`:
+
+    {"uptime": 3600.2,
+     "counters": {"pulses": 812, "firebase.patch.errors": 3},
+     "gauges": {"sms.outbox": 0, "journal.unacked": 2},
+     "histograms": {"pulse.cloud": {"count": 790, "mean": 0.41,
+                    "p50": 0.4096, "p90": 0.8192, "p99": 1.6384,
+                    "max": 1.93}}}
+
+Percentiles are bucket upper bounds, good to a factor of two.
+"""
+from array import array
+from bisect import bisect_left
+import json
+import os
+import threading
+import time
+
+_now = getattr(time, "monotonic", time.time)
+
+# Bucket upper bounds in seconds: 100 us doubling up to ~105 s.
+BOUNDS = [0.0001 * 2 ** k for k in range(21)]
+
+
+class Histogram(object):
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = array("L", [0] * (len(bounds) + 1))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the `q` quantile (0..1).
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for k, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.bounds[k], self.max) if k < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, kind, value, tb):
+        self.metrics.observe(self.name, _now() - self.start)
+        if kind is not None:
+            self.metrics.incr(self.name + ".errors")
+        return False
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value):
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.observe(value)
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        """
+        Set gauge `name` to `value`, or to a callable read at snapshot
+        time.
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def timed(self, name):
+        """
+        Context manager that records the time spent in its block under
+        `name` and counts exceptions as `<name>.errors`.
+        """
+        return _Timer(self, name)
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict((k, h.summary()) for k, h in self.histograms.items())
+        for name, value in gauges.items():
+            if callable(value):
+                try:
+                    gauges[name] = value()
+                except Exception as e:
+                    gauges[name] = "error: %s" % e
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+
+METRICS = Metrics()
+
+
+class StatsWriter(threading.Thread):
+    """
+    Periodically dump a metrics snapshot to `path` as JSON.
+    """
+
+    def __init__(self, path="meter_stats.json", interval=10, metrics=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics or METRICS
+        self.stopped = threading.Event()
+
+    def write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.metrics.snapshot(), f, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                print("Writing stats to %s failed: %s" % (self.path, e))
+
+    def stop(self):
+        self.stopped.set()
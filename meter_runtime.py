@@ -0,0 +1,299 @@
+"""
+asyncio runtime for the prepaid meter.
+
+`MeterRuntime` runs one `MeterEngine` and its peripherals as
+cooperative tasks on a single event loop:
+
+  capture   samples every pulse input each `idle` seconds and queues
+            (meter, timestamp) edges
+  ledger    bills queued edges in per-meter batches
+  cloud     syncs dirty meters every `sync_interval` seconds and
+            uploads consumption history every `upload_interval`
+  modem     wakes on serial input and queues unsolicited result codes
+  recharge  applies recharge SMS announced by those result codes
+  sms       sends outbox messages as they fall due
+
+The queues between tasks are bounded. Blocking I/O runs in executors:
+one thread for the modem, so AT commands never interleave, one for
+Firebase, so a slow round trip never delays pulse capture, and one for
+billing, whose journal, rollup and outbox writes fsync. Nothing that
+takes the engine or outbox lock runs on the loop thread, since those
+locks are held across fsyncs. A full pulse
+queue does not lose pulses; edges that do not fit are held per meter
+and queued once the ledger catches up.
+
+`run()` returns after `stop()`, SIGINT or SIGTERM. Capture stops first,
+queued pulses are billed, a final sync pushes them to the cloud and the
+journal and rollups are flushed.
+
+Python 3 only.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import signal
+import time
+
+from meter_metrics import METRICS
+
+PULSE_QUEUE = 4096
+URC_QUEUE = 64
+# Seconds to wait for the stream thread to exit at shutdown.
+STREAM_JOIN = 1.0
+
+
+class MeterRuntime(object):
+
+    def __init__(self, engine, modem=None, outbox=None, ingester=None, stream=None,
+                 sync_interval=1.0, upload_interval=900, idle=0.001, queue_size=PULSE_QUEUE):
+        self.engine = engine
+        self.modem = modem
+        self.outbox = outbox
+        self.ingester = ingester
+        self.stream = stream
+        self.sync_interval = sync_interval
+        self.upload_interval = upload_interval
+        self.idle = idle
+        self.queue_size = queue_size
+        self.loop = None
+        self.stopping = None
+        self.pulses = None
+        self.urcs = None
+        self.backlog = [[] for _ in engine.names]   # edges waiting for queue space
+        self.queue_closed = False
+        self.captured = 0
+        self.billed = 0
+        self.ledger_executor = ThreadPoolExecutor(1)
+        self.cloud_executor = ThreadPoolExecutor(1)
+        self.modem_executor = ThreadPoolExecutor(1)
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def stop(self):
+        """
+        Ask the runtime to shut down. Safe to call from any thread.
+        """
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def _sleep(self, timeout):
+        """
+        Sleep up to `timeout` seconds. Returns True once stopping.
+        """
+        try:
+            await asyncio.wait_for(self.stopping.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping.is_set()
+
+    def _call(self, executor, fn, *args):
+        return self.loop.run_in_executor(executor, fn, *args)
+
+    async def _try(self, what, metric, executor, fn, *args):
+        """
+        Run `fn` in `executor`, logging and counting any failure so one
+        bad round trip or message never stops the task calling it.
+        Returns True if it succeeded.
+        """
+        try:
+            await self._call(executor, fn, *args)
+            return True
+        except Exception as e:
+            METRICS.incr(metric)
+            print("%s failed: %r" % (what, e))
+            return False
+
+    def _queue_edge(self, i, ts):
+        backlog = self.backlog[i]
+        if not backlog:
+            try:
+                self.pulses.put_nowait((i, ts))
+                return
+            except asyncio.QueueFull:
+                METRICS.incr("runtime.pulse_queue_full")
+        backlog.append(ts)
+
+    def _drain_backlog(self):
+        for i, backlog in enumerate(self.backlog):
+            while backlog and not self.pulses.full():
+                self.pulses.put_nowait((i, backlog.pop(0)))
+
+    async def capture(self):
+        engine = self.engine
+        while not self.stopping.is_set():
+            now = time.time()
+            for i in engine.sample(now):
+                self.captured += 1
+                self._queue_edge(i, now)
+            self._drain_backlog()
+            await asyncio.sleep(self.idle)
+        for i, backlog in enumerate(self.backlog):
+            while backlog:
+                await self.pulses.put((i, backlog.pop(0)))
+        await self.pulses.put(None)
+        self.queue_closed = True
+
+    def _bill(self, batch):
+        for i, stamps in batch.items():
+            self.engine.bill(i, len(stamps), stamps)
+            self.billed += len(stamps)
+
+    async def ledger(self):
+        while True:
+            item = await self.pulses.get()
+            done = item is None
+            batch = {}
+            if not done:
+                batch[item[0]] = [item[1]]
+            while not self.pulses.empty():
+                item = self.pulses.get_nowait()
+                if item is None:
+                    done = True
+                else:
+                    batch.setdefault(item[0], []).append(item[1])
+            if batch:
+                # Capture keeps queueing while this batch is billed.
+                await self._call(self.ledger_executor, self._bill, batch)
+            if done:
+                return
+
+    async def cloud(self):
+        engine = self.engine
+        last_upload = last_sync = time.time()
+        # Syncs start every `sync_interval` seconds however long the last
+        # round trip took.
+        while not await self._sleep(last_sync + self.sync_interval - time.time()):
+            last_sync = time.time()
+            await self._try("Pulse analytics", "cloud.errors", self.cloud_executor,
+                            engine.analyze, last_sync)
+            if engine.dirty:
+                await self._try("Cloud sync", "cloud.errors", self.cloud_executor, engine.sync)
+            if engine.rollup is not None and time.time() - last_upload >= self.upload_interval:
+                last_upload = time.time()
+                await self._try("History upload", "cloud.errors", self.cloud_executor,
+                                engine.upload_history)
+
+    async def modem_reader(self):
+        modem = self.modem
+        readable = asyncio.Event()
+        self.loop.add_reader(modem.fd, readable.set)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(readable.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+                readable.clear()
+                if not await self._try("Modem read", "modem.errors", self.modem_executor, modem.poll):
+                    # Don't spin on a port that keeps failing.
+                    await asyncio.sleep(1.0)
+                # URCs also pile up while other tasks run AT commands.
+                while modem.urcs:
+                    await self.urcs.put(modem.urcs.popleft())
+        finally:
+            self.loop.remove_reader(modem.fd)
+
+    async def recharge(self):
+        await self._try("Recharge backlog", "recharge.errors", self.modem_executor,
+                        self.ingester.process_backlog)
+        while True:
+            line = await self.urcs.get()
+            await self._try("Recharge SMS handling", "recharge.errors", self.modem_executor,
+                            self.ingester.handle_urc, line)
+
+    async def sms(self):
+        outbox = self.outbox
+        while not self.stopping.is_set():
+            try:
+                msg, wake = await self._call(self.modem_executor, outbox.due)
+            except Exception as e:
+                METRICS.incr("sms.errors")
+                print("SMS outbox failed: %r" % e)
+                msg, wake = None, None
+            if msg is None:
+                timeout = 1.0 if wake is None else min(max(wake - time.time(), 0.01), 1.0)
+                await self._sleep(timeout)
+                continue
+            await self._try("SMS send", "sms.errors", self.modem_executor, outbox.send_one, msg)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.pulses = asyncio.Queue(self.queue_size)
+        self.urcs = asyncio.Queue(URC_QUEUE)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not the main thread, or no signal support.
+                pass
+        METRICS.gauge("queue.pulses", self.pulses.qsize)
+        METRICS.gauge("queue.urcs", self.urcs.qsize)
+        METRICS.gauge("queue.backlog", lambda: sum(len(b) for b in self.backlog))
+
+        capture = asyncio.ensure_future(self.capture())
+        ledger = asyncio.ensure_future(self.ledger())
+        workers = [asyncio.ensure_future(self.cloud())]
+        services = []
+        if self.modem is not None:
+            services.append(asyncio.ensure_future(self.modem_reader()))
+            if self.ingester is not None:
+                services.append(asyncio.ensure_future(self.recharge()))
+        if self.outbox is not None:
+            workers.append(asyncio.ensure_future(self.sms()))
+        if self.stream is not None:
+            self.stream.start()
+
+        for task in workers + services:
+            task.add_done_callback(self._report)
+
+        # Only losing capture or billing stops the meter; the other tasks
+        # handle their own errors.
+        stop = asyncio.ensure_future(self.stopping.wait())
+        done, _ = await asyncio.wait([stop, capture, ledger], return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task is not stop and task.exception() is not None:
+                print("Meter task failed: %r" % task.exception())
+        self.stopping.set()
+        await self.shutdown(capture, ledger, workers, services)
+
+    @staticmethod
+    def _report(task):
+        if not task.cancelled() and task.exception() is not None:
+            METRICS.incr("runtime.task_errors")
+            print("Meter task failed: %r" % task.exception())
+
+    def _stop_stream(self):
+        self.stream.stop()
+        self.stream.join(STREAM_JOIN)
+
+    async def shutdown(self, capture, ledger, workers, services):
+        stream = None
+        if self.stream is not None:
+            # Runs in the default executor while the tasks wind down.
+            stream = self.loop.run_in_executor(None, self._stop_stream)
+        for task in services:
+            task.cancel()
+        await asyncio.gather(*services, return_exceptions=True)
+        await asyncio.gather(*workers, return_exceptions=True)
+        if ledger.done():
+            # Nothing will drain the queue; don't wait on a full one.
+            capture.cancel()
+        await asyncio.gather(capture, return_exceptions=True)
+        if not ledger.done() and not self.queue_closed:
+            await self.pulses.put(None)
+        await asyncio.gather(ledger, return_exceptions=True)
+        if stream is not None:
+            await stream
+        engine = self.engine
+        if engine.dirty:
+            await self._try("Final sync (pulses stay journaled)", "cloud.errors",
+                            self.cloud_executor, engine.sync)
+        if engine.journal is not None:
+            await self._call(self.ledger_executor, engine.journal.flush)
+        if engine.rollup is not None:
+            await self._call(self.ledger_executor, engine.rollup.save)
+        self.ledger_executor.shutdown(wait=True)
+        self.cloud_executor.shutdown(wait=True)
+        self.modem_executor.shutdown(wait=True)
@@ -0,0 +1,540 @@
+"""
+Prepaid meter engine that drives any number of meters from one process.
+
+Meters come from a config mapping of name to settings:
+
+    METERS = {
+        "Master": {"pin": 38, "led": 40, "path": "/Master", "phone": "9503436450"},
+    }
+
+`pin` is the pulse input, `led` the pulse indicator output and `path`
+the Firebase node holding `Balance` and `MeterReading` (or give full
+`balance`/`reading` paths instead). Balances and readings live in
+`array` columns indexed by meter, all inputs are sampled in one pass by
+`scan()`, and `sync()` pushes every dirty meter in a single PATCH.
+
+Remote top-ups are merged as deltas: any change to a balance since the
+value we last wrote is added to the local balance. Changes arrive
+through `apply_remote()`, fed by a `firebase_stream.BalanceStream`;
+without a live stream `sync()` falls back to one GET of the meters'
+common root before writing.
+The stream also echoes our own writes, possibly late; balances written
+while streaming are remembered per meter until their echo arrives and
+are never taken for top-ups.
+
+With a `pulse_journal.PulseJournal` attached, every pulse is journaled
+before it is billed and each meter's last journal sequence is written
+as `<balance path>Seq` in the same PATCH as its balance. `load()`
+replays journal records newer than that sequence, so pulses billed
+before a crash or while offline reach the cloud exactly once.
+
+Billing goes through a `tariff.Tariff` (flat `rate` per pulse unless one
+is given). The units used this month are kept per meter and written as
+`<balance path>Period` so slab pricing survives restarts, and low
+balance alerts fire once per threshold in `tariff.Thresholds`.
+
+With `rollup_path` set, pulses are also counted into per-minute and
+per-hour `consumption_rollup.Rollup` buckets under each meter's
+`history` path (default `<path>/History`), uploaded in one PATCH every
+`upload_interval` seconds by `run()`.
+
+With a `pulse_analytics.PulseAnalytics` attached, billed pulse
+timestamps are kept in its ring buffer and `analyze()` computes each
+meter's pulse rate, interval percentiles, bounce count and flat-line /
+stuck flags every `analytics.interval` seconds. Meters whose results
+changed get them written as `<balance path>Load`, with `load` in units
+per hour, in the next sync.
+
+Pulse-to-ledger and pulse-to-cloud latency, Firebase round trips and
+queue depths are recorded in `meter_metrics.METRICS`.
+"""
+from array import array
+import threading
+import time
+
+from consumption_rollup import Rollup
+from meter_metrics import METRICS
+from recharge_sms import sender_matches
+from tariff import Tariff, Thresholds
+
+RATE_PER_PULSE = 5
+UNITS_PER_PULSE = 1
+LOW_BALANCE = 50
+LED_ON_TIME = 0.3
+# Own writes remembered per meter until the stream echoes them back.
+ECHOES = 16
+
+
+def _join(*parts):
+    return "/" + "/".join(p.strip("/") for p in parts if p.strip("/"))
+
+
+def _common_root(paths):
+    split = [p.strip("/").split("/") for p in paths]
+    root = []
+    for parts in zip(*split):
+        if len(set(parts)) != 1:
+            break
+        root.append(parts[0])
+    return "/" + "/".join(root)
+
+
+def _lookup(tree, root, path):
+    """
+    Value at `path` inside `tree`, the JSON fetched from `root`.
+    """
+    rel = path[len(root):].strip("/")
+    node = tree
+    for part in rel.split("/") if rel else []:
+        if not isinstance(node, dict) or part not in node:
+            return None
+        node = node[part]
+    return node
+
+
+def _units(value):
+    """
+    JSON value for a unit count: an int when whole, so integral
+    readings are written as before.
+    """
+    value = round(value, 3)
+    return int(value) if value == int(value) else value
+
+
+def _month_start(period):
+    """
+    Epoch time at which the "%Y-%m" `period` starts, local time.
+    """
+    return time.mktime(time.strptime(period, "%Y-%m"))
+
+
+def _history_path(name, config):
+    if config.get("history"):
+        return config["history"]
+    if config.get("path"):
+        return _join(config["path"], "History")
+    return _join("History", name)
+
+
+class MeterEngine(object):
+
+    def __init__(self, meters, gpio, firebase, rate=RATE_PER_PULSE,
+                 units=UNITS_PER_PULSE, low_balance=LOW_BALANCE,
+                 on_low_balance=None, led_time=LED_ON_TIME, journal=None,
+                 tariff=None, rollup_path=None, analytics=None):
+        self.gpio = gpio
+        self.firebase = firebase
+        self.rate = rate
+        # `units` only applies to the flat tariff built without `tariff`.
+        self.tariff = tariff or Tariff.flat(rate, units, thresholds=[low_balance])
+        self.on_low_balance = on_low_balance
+        self.led_time = led_time
+        self.journal = journal
+        self.analytics = analytics
+        self.lock = threading.Lock()
+        self.running = True
+
+        self.names = sorted(meters)
+        self.config = [meters[n] for n in self.names]
+        self.pins = [c["pin"] for c in self.config]
+        self.leds = [c.get("led") for c in self.config]
+        self.balance_paths = [c.get("balance") or _join(c["path"], "Balance") for c in self.config]
+        self.reading_paths = [c.get("reading") or _join(c["path"], "MeterReading") for c in self.config]
+        self.seq_paths = [p + "Seq" for p in self.balance_paths]
+        self.period_paths = [p + "Period" for p in self.balance_paths]
+        self.load_paths = [p + "Load" for p in self.balance_paths]
+        self.history_paths = [_history_path(n, c) for n, c in zip(self.names, self.config)]
+        self.root = _common_root(self.balance_paths + self.reading_paths)
+        self.rollup = Rollup(self.history_paths, rollup_path) if rollup_path else None
+
+        n = len(self.names)
+        self.balances = array("l", [0] * n)
+        # Units are fractional with meters that give more than one
+        # pulse per unit.
+        self.readings = array("d", [0] * n)
+        self.synced = array("l", [0] * n)      # balance as last written to the cloud
+        self.echoes = [[] for _ in range(n)]   # balances written, echo not yet seen
+        self.seqs = array("L", [0] * n)        # last journal sequence billed
+        self.levels = array("b", [0] * n)      # last sampled input level
+        self.alerts = Thresholds(self.tariff.thresholds, n)
+        self.period = time.strftime("%Y-%m")
+        self.period_start = _month_start(self.period)
+        self.period_units = array("d", [0] * n)  # units used this month
+        self.carry = array("d", [0.0] * n)       # billed fractions not yet charged
+        self.led_off_at = [None] * n
+        self.dirty = 0                         # bitmask of meters to sync
+        self.unsynced_since = None             # time of the oldest unsynced pulse
+        self.streaming = False                 # set while a BalanceStream is live
+        self.loads = [None] * n                # last pulse analytics per meter
+        self.load_pending = 0                  # bitmask of loads to sync
+        self.analyzed_at = 0
+
+        METRICS.gauge("meters.dirty", lambda: bin(self.dirty).count("1"))
+        if journal is not None:
+            METRICS.gauge("journal.unacked", lambda: journal.seq - journal.acked)
+
+    def setup(self):
+        g = self.gpio
+        g.setmode(g.BOARD)
+        for c in self.config:
+            if c.get("pull") == "down":
+                g.setup(c["pin"], g.IN, pull_up_down=g.PUD_DOWN)
+            else:
+                g.setup(c["pin"], g.IN)
+            if c.get("led") is not None:
+                g.setup(c["led"], g.OUT)
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def meter_for_phone(self, phone):
+        """
+        Index of the meter whose `phone` matches, else None.
+        """
+        for i, c in enumerate(self.config):
+            if c.get("phone") and sender_matches(phone, [c["phone"]]):
+                return i
+        return None
+
+    def phones(self):
+        """
+        Configured phone numbers, the senders allowed to recharge.
+        """
+        return [c["phone"] for c in self.config if c.get("phone")]
+
+    def load(self):
+        """
+        Initialise balances and readings from the cloud in one GET, then
+        replay journaled pulses the cloud has not seen yet.
+        """
+        tree = self.firebase.get(self.root, None) or {}
+        for i in range(len(self.names)):
+            balance = _lookup(tree, self.root, self.balance_paths[i]) or 0
+            reading = _lookup(tree, self.root, self.reading_paths[i])
+            self.balances[i] = int(balance)
+            self.synced[i] = int(balance)
+            self.readings[i] = float(reading) if reading is not None else int(balance) // self.rate
+            self.seqs[i] = int(_lookup(tree, self.root, self.seq_paths[i]) or 0)
+            period = _lookup(tree, self.root, self.period_paths[i]) or {}
+            if period.get("month") == self.period:
+                self.period_units[i] = float(period.get("units", 0))
+        if self.journal is not None:
+            self.replay()
+
+    def replay(self):
+        """
+        Re-bill journal records newer than each meter's cloud sequence.
+        Returns the number of records applied.
+        """
+        applied = 0
+        with self.lock:
+            for seq, ts, i, delta in self.journal.unsynced():
+                if i < len(self.names) and seq > self.seqs[i]:
+                    self._apply(i, delta, [ts] * delta)
+                    self.seqs[i] = seq
+                    applied += 1
+            self.journal.seq = max([self.journal.seq] + list(self.seqs))
+        if applied:
+            print("Replayed %d journaled pulses" % applied)
+        return applied
+
+    def set_balance(self, i, value):
+        with self.lock:
+            self.balances[i] = int(value)
+            self.dirty |= 1 << i
+            self._check_alert(i)
+
+    def _check_alert(self, i):
+        for threshold in self.alerts.update(i, self.balances[i]):
+            if self.on_low_balance:
+                self.on_low_balance(self.names[i], self.balances[i], threshold)
+
+    def _rollover(self, ts):
+        """
+        Start a new month if `ts` is in one. Never goes back: late
+        stamps must not reset the current month.
+        """
+        period = time.strftime("%Y-%m", time.localtime(ts))
+        if period > self.period:
+            self.period = period
+            self.period_start = _month_start(period)
+            for i in range(len(self.names)):
+                self.period_units[i] = 0
+                self.dirty |= 1 << i
+
+    def _apply(self, i, pulses, stamps=None):
+        self._rollover(max(stamps) if stamps else time.time())
+        cost = self.carry[i]
+        late = 0
+        if stamps and min(stamps) < self.period_start:
+            # Pulses from an earlier month, e.g. replayed from the
+            # journal, are billed at the current slab but do not count
+            # towards this month's units.
+            old = [t for t in stamps if t < self.period_start]
+            stamps = [t for t in stamps if t >= self.period_start]
+            late = len(old)
+            cost += self.tariff.cost(self.period_units[i], late, old)
+        if pulses > late:
+            cost += self.tariff.cost(self.period_units[i], pulses - late, stamps)
+        charge = int(round(cost))
+        self.carry[i] = cost - charge
+        self.balances[i] -= charge
+        self.readings[i] -= pulses * self.tariff.units_per_pulse
+        self.period_units[i] += (pulses - late) * self.tariff.units_per_pulse
+        self.dirty |= 1 << i
+        self._check_alert(i)
+
+    def bill(self, i, pulses=1, stamps=None):
+        """
+        Bill `pulses` pulses on meter `i` in one step. `stamps`, one
+        timestamp per pulse, enables time-of-day rates.
+        """
+        now = time.time()
+        with self.lock:
+            if self.journal is not None:
+                if stamps:
+                    for ts in stamps:
+                        self.seqs[i] = self.journal.append(i, 1, ts)
+                else:
+                    self.seqs[i] = self.journal.append(i, pulses)
+            self._apply(i, pulses, stamps)
+            if self.analytics is not None and stamps:
+                self.analytics.record_many(i, stamps)
+            if self.rollup is not None:
+                if stamps:
+                    for ts in stamps:
+                        self.rollup.add(i, ts)
+                else:
+                    self.rollup.add(i, now, pulses)
+            if self.unsynced_since is None:
+                self.unsynced_since = stamps[0] if stamps else now
+        METRICS.incr("pulses", pulses)
+        if stamps:
+            METRICS.observe("pulse.ledger", time.time() - stamps[0])
+
+    def sample(self, now):
+        """
+        Sample every pulse input once and drive the pulse LEDs. Returns
+        the meters that saw a rising edge, without billing them.
+        """
+        g = self.gpio
+        edges = []
+        for i, pin in enumerate(self.pins):
+            level = 1 if g.input(pin) else 0
+            if level and not self.levels[i]:
+                edges.append(i)
+                if self.leds[i] is not None:
+                    g.output(self.leds[i], True)
+                    self.led_off_at[i] = now + self.led_time
+            self.levels[i] = level
+            off = self.led_off_at[i]
+            if off is not None and now >= off:
+                g.output(self.leds[i], False)
+                self.led_off_at[i] = None
+        return edges
+
+    def scan(self, now=None):
+        """
+        Sample every pulse input once and bill rising edges. Returns the
+        number of pulses seen.
+        """
+        now = time.time() if now is None else now
+        edges = self.sample(now)
+        for i in edges:
+            self.bill(i, 1, [now])
+        return len(edges)
+
+    def analyze(self, now=None):
+        """
+        Run the pulse analytics if `analytics.interval` has passed and
+        mark meters whose results changed for the next sync. Returns
+        True if it ran.
+        """
+        now = time.time() if now is None else now
+        if self.analytics is None or now - self.analyzed_at < self.analytics.interval:
+            return False
+        with self.lock:
+            self.analyzed_at = now
+            with METRICS.timed("analytics.window"):
+                loads = self.analytics.analyze(now, self.levels)
+            for i, load in enumerate(loads):
+                if load["rate"] is not None:
+                    load["load"] = round(load["rate"] * 60 * self.tariff.units_per_pulse, 3)
+                if load != self.loads[i]:
+                    self.loads[i] = load
+                    self.load_pending |= 1 << i
+                    self.dirty |= 1 << i
+        return True
+
+    def _merge(self, i, remote):
+        """
+        Fold a cloud balance into meter `i`. Caller holds `self.lock`.
+        """
+        remote = int(remote)
+        echoes = self.echoes[i]
+        if remote in echoes:
+            # Our own write echoed back, possibly after later writes
+            # completed. Echoes arrive in write order, so older ones
+            # were missed and are dropped too.
+            del echoes[:echoes.index(remote) + 1]
+            # The cloud held this value; later changes are measured
+            # from it.
+            self.synced[i] = remote
+            return
+        if remote == self.synced[i]:
+            return
+        self.balances[i] += remote - self.synced[i]
+        self.synced[i] = remote
+        self.dirty |= 1 << i
+        self._check_alert(i)
+
+    def merge_remote(self):
+        """
+        Fold top-ups made elsewhere into local balances: anything the
+        cloud gained since our last write is added here.
+        """
+        with METRICS.timed("firebase.get"):
+            tree = self.firebase.get(self.root, None) or {}
+        with self.lock:
+            for i in range(len(self.names)):
+                # The read already reflects our completed writes, and any
+                # echoes left from a dropped stream will not arrive.
+                del self.echoes[i][:]
+                remote = _lookup(tree, self.root, self.balance_paths[i])
+                if remote is not None:
+                    self._merge(i, remote)
+
+    def apply_remote(self, path, data, patch=False):
+        """
+        Apply a streamed change: `data` was written at `path`, relative
+        to `self.root`. A patch carries a mapping of child paths.
+        """
+        if patch:
+            for key, value in data.items():
+                self.apply_remote(_join(path, key), value)
+            return
+        base = _join(self.root, path)
+        with self.lock:
+            for i, bp in enumerate(self.balance_paths):
+                if bp == base:
+                    value = data
+                elif base == "/" or bp.startswith(base + "/"):
+                    value = _lookup(data, base, bp)
+                else:
+                    continue
+                if value is not None:
+                    self._merge(i, value)
+
+    def sync(self):
+        """
+        Write every dirty meter in one PATCH. Returns the number synced.
+        """
+        if not self.streaming:
+            self.merge_remote()
+        with self.lock:
+            dirty = self.dirty
+            if not dirty:
+                return 0
+            update = {}
+            written = []
+            for i in range(len(self.names)):
+                if dirty & (1 << i):
+                    update[self.balance_paths[i][len(self.root):].strip("/")] = self.balances[i]
+                    update[self.reading_paths[i][len(self.root):].strip("/")] = _units(self.readings[i])
+                    if self.journal is not None:
+                        update[self.seq_paths[i][len(self.root):].strip("/")] = self.seqs[i]
+                    update[self.period_paths[i][len(self.root):].strip("/")] = {
+                        "month": self.period, "units": _units(self.period_units[i])}
+                    if self.load_pending & (1 << i):
+                        update[self.load_paths[i][len(self.root):].strip("/")] = self.loads[i]
+                    written.append((i, self.balances[i], self.synced[i]))
+                    if self.streaming:
+                        self.echoes[i].append(self.balances[i])
+                        del self.echoes[i][:-ECHOES]
+            self.dirty = 0
+            loads = self.load_pending & dirty
+            self.load_pending &= ~dirty
+            since, self.unsynced_since = self.unsynced_since, None
+            acked = self.journal.seq if self.journal is not None else 0
+        try:
+            if self.journal is not None:
+                # The journal must be durable up to `acked` before the
+                # cloud is ahead of it. Those records are already written,
+                # so the fsync can run outside the lock and not hold up
+                # billing.
+                self.journal.flush()
+            with METRICS.timed("firebase.patch"):
+                self.firebase.patch(self.root, update)
+        except Exception:
+            with self.lock:
+                self.dirty |= dirty
+                self.load_pending |= loads
+                if since is not None and (self.unsynced_since is None or since < self.unsynced_since):
+                    self.unsynced_since = since
+                # Echoes stay expected: a timed out PATCH may still have
+                # been applied.
+            raise
+        with self.lock:
+            for i, balance, before in written:
+                # A merge while the PATCH was in flight already moved
+                # `synced` on from this write.
+                if self.synced[i] == before:
+                    self.synced[i] = balance
+            if self.journal is not None:
+                self.journal.ack(acked)
+        if since is not None:
+            METRICS.observe("pulse.cloud", time.time() - since)
+        return len(written)
+
+    def upload_history(self):
+        """
+        Upload closed consumption buckets in one PATCH. Returns the
+        number of buckets written.
+        """
+        with self.lock:
+            update, minute, hour = self.rollup.pending()
+        if update:
+            with METRICS.timed("firebase.history"):
+                self.firebase.patch("/", update)
+        with self.lock:
+            self.rollup.mark_uploaded(minute, hour)
+        return len(update)
+
+    def run(self, sync_interval=1.0, idle=0.001, upload_interval=900):
+        """
+        Capture pulses continuously, sync dirty meters at most every
+        `sync_interval` seconds and upload closed consumption buckets
+        every `upload_interval` seconds.
+        """
+        last_sync = 0
+        last_upload = time.time()
+        last_scan = last_report = time.time()
+        worst_gap = 0.0
+        while self.running:
+            self.scan()
+            now = time.time()
+            # Longest wait between two input samples, reported once per
+            # sync interval rather than per scan to keep the loop cheap.
+            worst_gap = max(worst_gap, now - last_scan)
+            last_scan = now
+            if now - last_report >= sync_interval:
+                METRICS.observe("loop.scan_gap", worst_gap)
+                last_report = now
+                worst_gap = 0.0
+            self.analyze(now)
+            if self.dirty and now - last_sync >= sync_interval:
+                last_sync = now
+                try:
+                    self.sync()
+                except IOError as e:
+                    print("Cloud sync failed: %s" % e)
+            if self.rollup is not None and now - last_upload >= upload_interval:
+                last_upload = now
+                try:
+                    self.upload_history()
+                except IOError as e:
+                    print("History upload failed: %s" % e)
+            time.sleep(idle)
+
+    def stop(self):
+        self.running = False
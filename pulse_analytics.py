@@ -0,0 +1,193 @@
+"""
+Pulse-interval analytics for load estimation and tamper detection.
+
+`PulseAnalytics` keeps the timestamps of the last `size` pulses of every
+meter in a ring buffer and analyses all meters at once:
+
+  rate      pulses per minute over the last `rate_window` seconds, or
+            over the ring's time span when the ring holds less than
+            that (above size / rate_window pulses per second)
+  p50/p90/p99
+            pulse interval percentiles over the whole ring, in seconds
+  bounces   intervals shorter than `debounce` in the last `recent`
+            seconds, i.e. contact bounce or injected pulses. `debounce`
+            defaults to half the shortest real interval, 0.5 / `max_rate`,
+            so `max_rate` must be the meter's highest pulse rate
+            (impulses per unit x maximum load per hour / 3600)
+
+and raises flags:
+
+  flat_line no pulse for `flat_factor` median intervals (and at least
+            `flat_min` seconds) on a meter that was pulsing
+  bounce    at least `bounce_limit` bounces
+  stuck     the input has been held high for `stuck_time` seconds
+
+With NumPy installed the ring is one float64 array and `analyze()` works
+on a (meters, size) view with whole-array operations, so its cost
+depends on the ring size, not on the pulse rate. Without NumPy the same
+analysis runs per meter over an `array`.
+"""
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RING_SIZE = 1024
+RATE_WINDOW = 60.0
+MAX_RATE = 10.0
+RECENT = 3600.0
+BOUNCE_LIMIT = 3
+FLAT_FACTOR = 20
+FLAT_MIN = 900.0
+STUCK_TIME = 10.0
+INTERVAL = 60.0
+
+NAN = float("nan")
+PERCENTILES = (50, 90, 99)
+
+
+def _percentile(ordered, p):
+    """
+    Linearly interpolated percentile of a sorted list, as NumPy does.
+    """
+    pos = (len(ordered) - 1) * p / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+def _round(value):
+    return None if value != value else round(float(value), 3)
+
+
+class PulseAnalytics(object):
+
+    def __init__(self, meters, size=RING_SIZE, rate_window=RATE_WINDOW,
+                 max_rate=MAX_RATE, debounce=None, recent=RECENT, bounce_limit=BOUNCE_LIMIT,
+                 flat_factor=FLAT_FACTOR, flat_min=FLAT_MIN, stuck_time=STUCK_TIME,
+                 interval=INTERVAL, vectorized=None):
+        self.meters = meters
+        self.size = size
+        self.rate_window = rate_window
+        self.debounce = 0.5 / max_rate if debounce is None else debounce
+        self.recent = recent
+        self.bounce_limit = bounce_limit
+        self.flat_factor = flat_factor
+        self.flat_min = flat_min
+        self.stuck_time = stuck_time
+        self.interval = interval      # seconds between analyses, for the engine
+        self.vectorized = numpy is not None if vectorized is None else vectorized
+        if self.vectorized and numpy is None:
+            raise ImportError("vectorized pulse analytics need numpy")
+
+        n = meters * size
+        if self.vectorized:
+            self.stamps = numpy.full(n, NAN)
+            # Reading order of every ring, oldest slot first, is
+            # (head + cols) % size.
+            self._rows = numpy.arange(meters)[:, None]
+            self._cols = numpy.arange(size)[None, :]
+        else:
+            self.stamps = array("d", [NAN] * n)
+        self.heads = array("l", [0] * meters)   # next slot to write
+
+    def record(self, i, ts):
+        head = self.heads[i]
+        self.stamps[i * self.size + head] = ts
+        self.heads[i] = (head + 1) % self.size
+
+    def record_many(self, i, stamps):
+        for ts in stamps:
+            self.record(i, ts)
+
+    def analyze(self, now, levels=None):
+        """
+        Analyse every meter's window. `levels` are the current input
+        levels, needed for the stuck flag. Returns one dict per meter.
+        """
+        if self.vectorized:
+            columns = self._analyze_numpy(now)
+        else:
+            columns = self._analyze_python(now)
+        results = []
+        full = now - self.rate_window
+        for i, (pulses, first, last, recent, bounces, p50, p90, p99) in enumerate(zip(*columns)):
+            if pulses == self.size and first > full:
+                # The ring is shorter than the rate window. Measure to
+                # now, so the rate decays once pulses stop.
+                rate = (pulses - 1) * 60.0 / max(max(now, last) - first, 1e-9)
+            else:
+                rate = recent * 60.0 / self.rate_window
+            flags = []
+            if p50 == p50 and now - last >= max(self.flat_min, self.flat_factor * p50):
+                flags.append("flat_line")
+            if bounces >= self.bounce_limit:
+                flags.append("bounce")
+            if levels is not None and levels[i] and pulses and now - last >= self.stuck_time:
+                flags.append("stuck")
+            results.append({
+                "pulses": int(pulses),
+                "rate": _round(rate),
+                "p50": _round(p50),
+                "p90": _round(p90),
+                "p99": _round(p99),
+                "bounces": int(bounces),
+                "flags": flags,
+            })
+        return results
+
+    def _analyze_numpy(self, now):
+        np = numpy
+        ring = self.stamps.reshape(self.meters, self.size)
+        heads = np.frombuffer(self.heads, dtype=np.dtype(self.heads.typecode))
+        ts = ring[self._rows, (heads[:, None] + self._cols) % self.size]
+        # Empty slots are NaN, and every comparison with NaN is False.
+        pulses = self.size - np.isnan(ts).sum(axis=1)
+        first = ts[self._rows[:, 0], np.minimum(self.size - pulses, self.size - 1)]
+        last = ts[:, -1]
+        recent = (ts >= now - self.rate_window).sum(axis=1)
+        gaps = np.diff(ts, axis=1)
+        bounces = ((gaps < self.debounce) & (ts[:, 1:] >= now - self.recent)).sum(axis=1)
+        # NaN sorts last, so each row's intervals are its first
+        # pulses - 1 entries; interpolate between them as
+        # numpy.percentile does.
+        gaps.sort(axis=1)
+        n = np.maximum(pulses - 1, 1)[:, None]
+        pos = (n - 1) * (np.array(PERCENTILES, dtype=float) / 100.0)[None, :]
+        lo = pos.astype(int)
+        hi = np.minimum(lo + 1, n - 1)
+        below = np.take_along_axis(gaps, lo, axis=1)
+        above = np.take_along_axis(gaps, hi, axis=1)
+        p = below + (above - below) * (pos - lo)
+        return pulses, first, last, recent, bounces, p[:, 0], p[:, 1], p[:, 2]
+
+    def _analyze_python(self, now):
+        size = self.size
+        columns = ([], [], [], [], [], [], [], [])
+        since_rate = now - self.rate_window
+        since_recent = now - self.recent
+        for i in range(self.meters):
+            base = i * size
+            head = self.heads[i]
+            ring = self.stamps[base:base + size]
+            ts = [t for t in ring[head:] + ring[:head] if t == t]
+            gaps = []
+            bounces = 0
+            for prev, t in zip(ts, ts[1:]):
+                gap = t - prev
+                gaps.append(gap)
+                if gap < self.debounce and t >= since_recent:
+                    bounces += 1
+            gaps.sort()
+            p = [_percentile(gaps, q) if gaps else NAN for q in PERCENTILES]
+            recent = 0
+            for t in reversed(ts):
+                if t < since_rate:
+                    break
+                recent += 1
+            for column, value in zip(columns, [len(ts), ts[0] if ts else NAN, ts[-1] if ts else NAN,
+                                               recent, bounces] + p):
+                column.append(value)
+        return columns
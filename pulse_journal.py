@@ -0,0 +1,139 @@
+"""
+Append-only local journal of billed pulses.
+
+Every pulse is written here before it touches a balance, as one fixed
+size record (sequence number, timestamp, meter index, delta). Records
+are buffered and fsync'd in batches, either every `fsync_every`
+records or every `fsync_interval` seconds, so an SD card is not hit
+with one flush per pulse.
+
+The last sequence acknowledged by the cloud is kept in `<path>.ack`.
+`unsynced()` returns the records after it for replay, and `compact()`
+rewrites the journal without the acknowledged prefix. Replay is
+idempotent because the cloud stores each meter's last applied sequence
+next to its balance (see `MeterEngine.sync`).
+
+`append()`, `flush()` and `compact()` share a lock, so `flush()` may be
+called from another thread and returns only once every record appended
+before it is on disk.
+"""
+import os
+import struct
+import threading
+import time
+
+RECORD = struct.Struct("<QdHh")   # seq, timestamp, meter, delta
+COMPACT_AFTER = 4096              # acknowledged records before compacting
+
+
+class PulseJournal(object):
+
+    def __init__(self, path, fsync_every=64, fsync_interval=1.0):
+        self.path = path
+        self.ack_path = path + ".ack"
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.acked = self._read_ack()
+        self.seq = self.acked
+        self._pending = 0
+        self._last_fsync = time.time()
+        self.lock = threading.RLock()
+        self._repair()
+        for seq, _, _, _ in self.unsynced():
+            self.seq = seq
+        self.f = open(path, "ab")
+
+    def _read_ack(self):
+        try:
+            with open(self.ack_path) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _repair(self):
+        """
+        Drop a torn record left at the tail by a crash mid-write.
+        """
+        if not os.path.exists(self.path):
+            return
+        size = os.path.getsize(self.path)
+        if size % RECORD.size:
+            with open(self.path, "r+b") as f:
+                f.truncate(size - size % RECORD.size)
+
+    def append(self, meter, delta, ts=None):
+        """
+        Record `delta` pulses for `meter` and return the sequence number.
+        """
+        with self.lock:
+            self.seq += 1
+            self.f.write(RECORD.pack(self.seq, time.time() if ts is None else ts, meter, delta))
+            self._pending += 1
+            if self._pending >= self.fsync_every or time.time() - self._last_fsync >= self.fsync_interval:
+                self.flush()
+            return self.seq
+
+    def flush(self):
+        with self.lock:
+            if not self._pending:
+                return
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self._pending = 0
+            self._last_fsync = time.time()
+
+    def records(self):
+        if getattr(self, "f", None):
+            self.f.flush()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            while True:
+                data = f.read(RECORD.size * 512)
+                if not data:
+                    break
+                for off in range(0, len(data) - len(data) % RECORD.size, RECORD.size):
+                    yield RECORD.unpack_from(data, off)
+
+    def unsynced(self):
+        """
+        Records newer than the last acknowledged sequence.
+        """
+        return [r for r in self.records() if r[0] > self.acked]
+
+    def ack(self, seq):
+        """
+        Mark everything up to `seq` as stored in the cloud.
+        """
+        if seq <= self.acked:
+            return
+        self.acked = seq
+        tmp = self.ack_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.ack_path)
+        if self.seq - self.acked < COMPACT_AFTER and os.path.getsize(self.path) >= COMPACT_AFTER * RECORD.size:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal keeping only unacknowledged records.
+        """
+        with self.lock:
+            self.flush()
+            keep = self.unsynced()
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                for r in keep:
+                    f.write(RECORD.pack(*r))
+                f.flush()
+                os.fsync(f.fileno())
+            self.f.close()
+            os.rename(tmp, self.path)
+            self.f = open(self.path, "ab")
+
+    def close(self):
+        self.flush()
+        self.f.close()
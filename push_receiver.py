@@ -0,0 +1,154 @@
+"""
+Local stand-in for the `remote-comm` end of PUSH_ADDR.
+
+`PushReceiver` binds the unix datagram socket at PUSH_ADDR, decodes each
+frame with `remote_events.decode()` and counts valid frames per event
+type, invalid frames and throughput, so the event path can be exercised
+and benchmarked on any Linux box without the device stack:
+
+    PUSH_ADDR=/tmp/push.sock python3 push_receiver.py --verbose
+
+Unix datagram sockets never drop silently: a full receive queue blocks
+the sender, or fails a non-blocking send with EAGAIN. Drops are
+therefore counted on the sending side (see
+`benchmarks/bench_push_events.py`) as frames sent but not received.
+"""
+import argparse
+import collections
+import os
+import socket
+import threading
+import time
+
+import remote_events as events
+
+MAX_FRAME = 65536
+
+
+class PushReceiver(threading.Thread):
+
+    def __init__(self, address: str, rcvbuf: int=None, keep: int=0, verbose: bool=False):
+        super().__init__()
+        self.daemon = True
+        self.address = address
+        self.verbose = verbose
+        if os.path.exists(address):
+            os.unlink(address)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if rcvbuf:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind(address)
+        self.sock.settimeout(0.2)
+        self.running = True
+        self.cond = threading.Condition()
+        self.received = 0
+        self.invalid = 0
+        self.bytes = 0
+        self.by_type = collections.Counter()
+        # Last `keep` decoded events and the last few rejects, for tests.
+        self.events = collections.deque(maxlen=keep or None) if keep else None
+        self.errors = collections.deque(maxlen=20)
+        self.first_at = None
+        self.last_at = None
+
+    def handle(self, frame: bytes):
+        now = time.time()
+        try:
+            event_type, payload = events.decode(frame)
+        except events.InvalidEvent as e:
+            event_type, payload = None, None
+            self.errors.append(str(e))
+            if self.verbose:
+                print(f"Invalid frame {frame!r}: {e}")
+        else:
+            if self.verbose:
+                print(f"{events.EVENT_NAMES[event_type]} {payload}")
+        with self.cond:
+            if self.first_at is None:
+                self.first_at = now
+            self.last_at = now
+            self.bytes += len(frame)
+            if event_type is None:
+                self.invalid += 1
+            else:
+                self.received += 1
+                self.by_type[events.EVENT_NAMES[event_type]] += 1
+                if self.events is not None:
+                    self.events.append((event_type, payload))
+            self.cond.notify_all()
+
+    def run(self):
+        while self.running:
+            try:
+                frame = self.sock.recv(MAX_FRAME)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self.running:
+                    raise
+                break
+            self.handle(frame)
+
+    def wait_for(self, count: int, timeout: float=5.0) -> bool:
+        """
+        Wait until `count` frames (valid or not) have arrived.
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.received + self.invalid < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def stats(self) -> dict:
+        with self.cond:
+            elapsed = (self.last_at - self.first_at) if self.first_at else 0.0
+            return {
+                "received": self.received,
+                "invalid": self.invalid,
+                "bytes": self.bytes,
+                "by_type": dict(self.by_type),
+                "rate": self.received / elapsed if elapsed else 0.0,
+            }
+
+    def reset(self):
+        with self.cond:
+            self.received = self.invalid = self.bytes = 0
+            self.by_type.clear()
+            self.first_at = self.last_at = None
+
+    def stop(self):
+        self.running = False
+        self.join(1.0)
+        self.sock.close()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--address", default=os.environ.get("PUSH_ADDR"),
+                        help="socket path (default: $PUSH_ADDR)")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between stats lines")
+    parser.add_argument("--verbose", action="store_true", help="print every frame")
+    args = parser.parse_args()
+    if not args.address:
+        parser.error("Missing --address or PUSH_ADDR")
+
+    receiver = PushReceiver(args.address, verbose=args.verbose)
+    receiver.start()
+    print(f"Listening on {args.address}")
+    try:
+        while True:
+            time.sleep(args.interval)
+            print(receiver.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Recharge SMS ingestion.
+
+A recharge is an SMS whose text carries a token `*#*#<value>#*#*`. With
+`AT+CNMI=2,1,0,0,0` the modem only announces new messages with
+`+CMTI: "SM",<index>`, so `RechargeIngester` watches the modem's URC
+queue, fetches each announced message with AT+CMGR, validates its
+tokens, hands them to `on_token` and deletes the message. Messages
+pushed inline (`+CMT:` header followed by the text) are handled from
+the same URC stream.
+
+`process_backlog()` reads every stored message with a single AT+CMGL,
+so SMS that piled up while the meter was down are applied in one pass.
+
+The ingester runs in its own thread and only touches the serial port
+through `gsm_modem.Modem`, so it never blocks the pulse loop.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+
+from gsm_modem import ModemError
+from meter_metrics import METRICS
+
+TOKEN_RE = re.compile(r"\*#\*#(\d{1,7})#\*#\*")
+MAX_TOKEN_VALUE = 100000
+# Digests of applied messages kept to reject replays.
+KEEP_APPLIED = 200
+
+
+def parse_cmti(line):
+    """
+    Storage index from a `+CMTI: "SM",<index>` URC, else None.
+    """
+    if not line.startswith("+CMTI:"):
+        return None
+    try:
+        return int(line.rsplit(",", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def parse_header(line):
+    """
+    Split an SMS header (`+CMGR:`, `+CMGL:` or `+CMT:`) into its fields.
+    """
+    fields = []
+    for field in line.split(":", 1)[1].split(","):
+        fields.append(field.strip().strip('"'))
+    return fields
+
+
+def extract_tokens(text):
+    """
+    Recharge values carried in `text`; anything out of range is dropped.
+    """
+    values = []
+    for m in TOKEN_RE.finditer(text):
+        value = int(m.group(1))
+        if 0 < value <= MAX_TOKEN_VALUE:
+            values.append(value)
+    return values
+
+
+def sender_matches(sender, numbers):
+    """
+    True if `sender` is one of `numbers` or ends with one, so a number
+    configured without its country code matches "+91..." senders.
+    """
+    return any(n and sender.endswith(n) for n in numbers)
+
+
+def parse_listing(lines):
+    """
+    Split an AT+CMGL reply into (index, sender, stamp, text) tuples.
+    """
+    messages = []
+    current = None
+    for line in lines:
+        if line.startswith("+CMGL:"):
+            fields = parse_header(line)
+            current = [int(fields[0]), fields[2], ",".join(fields[4:6]), []]
+            messages.append(current)
+        elif current is not None:
+            current[3].append(line)
+    return [(i, sender, stamp, "\n".join(body)) for i, sender, stamp, body in messages]
+
+
+class RechargeIngester(threading.Thread):
+
+    def __init__(self, modem, on_token, path="recharge_applied.json",
+                 allowed_senders=None, poll_interval=0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.modem = modem
+        self.on_token = on_token
+        self.path = path
+        self.allowed_senders = allowed_senders
+        self.poll_interval = poll_interval
+        self.running = True
+        self.applied = []
+        self._inline = None
+        if os.path.exists(path):
+            with open(path) as f:
+                self.applied = json.load(f)
+
+    def _save(self):
+        self.applied = self.applied[-KEEP_APPLIED:]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.applied, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+    def handle_message(self, sender, stamp, text):
+        """
+        Validate and apply one message. Returns the values applied.
+        """
+        if self.allowed_senders is not None and not sender_matches(sender, self.allowed_senders):
+            print("Ignoring SMS from unknown sender %s" % sender)
+            METRICS.incr("recharge.rejected")
+            return []
+        values = extract_tokens(text)
+        if not values:
+            return []
+        digest = hashlib.sha1(("%s|%s|%s" % (sender, stamp, text)).encode("utf-8")).hexdigest()
+        if digest in self.applied:
+            print("Ignoring replayed recharge SMS from %s" % sender)
+            METRICS.incr("recharge.replayed")
+            return []
+        for value in values:
+            self.on_token(value, sender)
+        self.applied.append(digest)
+        self._save()
+        METRICS.incr("recharge.applied", len(values))
+        return values
+
+    def fetch(self, index):
+        """
+        Read, apply and delete the message stored at `index`.
+        """
+        lines = self.modem.command("AT+CMGR=%d" % index)
+        if lines and lines[0].startswith("+CMGR:"):
+            fields = parse_header(lines[0])
+            self.handle_message(fields[1], ",".join(fields[3:5]), "\n".join(lines[1:]))
+        self.modem.command("AT+CMGD=%d" % index)
+
+    def process_backlog(self):
+        """
+        Apply every stored message with one AT+CMGL and delete them.
+        Returns the number of messages handled.
+        """
+        messages = parse_listing(self.modem.command('AT+CMGL="ALL"'))
+        for index, sender, stamp, text in messages:
+            self.handle_message(sender, stamp, text)
+        for index, _, _, _ in messages:
+            self.modem.command("AT+CMGD=%d" % index)
+        return len(messages)
+
+    def handle_urc(self, line):
+        if self._inline is not None:
+            fields = self._inline
+            self._inline = None
+            self.handle_message(fields[0], ",".join(fields[2:4]), line)
+            return
+        if line.startswith("+CMT:"):
+            self._inline = parse_header(line)
+            return
+        index = parse_cmti(line)
+        if index is not None:
+            self.fetch(index)
+
+    def run(self):
+        try:
+            self.process_backlog()
+        except (ModemError, IOError) as e:
+            print("Recharge backlog failed: %s" % e)
+            METRICS.incr("recharge.errors")
+        while self.running:
+            try:
+                if not self.modem.urcs:
+                    self.modem.poll(self.poll_interval)
+                while self.modem.urcs:
+                    self.handle_urc(self.modem.urcs.popleft())
+            except (ModemError, IOError) as e:
+                print("Recharge SMS handling failed: %s" % e)
+                METRICS.incr("recharge.errors")
+
+    def stop(self):
+        self.running = False
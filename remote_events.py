@@ -0,0 +1,238 @@
+"""
+Event frames exchanged with `remote-comm` over the PUSH_ADDR socket.
+
+Every event is one unix datagram holding three concatenated msgpack
+objects:
+
+    EVENT_VERSION, event type, payload map
+
+`encode()` and the per-event helpers build frames, `decode()` parses and
+validates one against `SCHEMAS`, and `EventSender` keeps a single
+connected socket to PUSH_ADDR instead of opening one per event.
+
+`PendingBatch` holds a group of frames on disk from before the first
+one is sent until the last one is, so a batch cut short by a crash is
+resent in full on the next start. Its default file is on persistent
+storage, `DEFAULT_PENDING_PATH`, so it does not depend on the working
+directory.
+"""
+import os
+import socket
+import struct
+
+import msgpack
+
+EVENT_VERSION = 1
+EVENT_TYPE_GUEST_REG = 2
+EVENT_TYPE_MEM_GUEST_DECL = 3
+EVENT_TYPE_REMOTE_ACTIVITY = 25
+
+MEMBER_KEYS = 12
+GUEST_KEYS = 5
+
+# Payload fields and their types per event type.
+SCHEMAS = {
+    EVENT_TYPE_GUEST_REG: {
+        "Guest_id": int, "Registering": bool, "Guest_age": int, "Guest_male": bool,
+    },
+    EVENT_TYPE_MEM_GUEST_DECL: {
+        "Member_Keys": list, "Guests": list, "Confidence": int,
+    },
+    EVENT_TYPE_REMOTE_ACTIVITY: {
+        "Lock": bool, "ORR": bool, "Absent_Key_Press": bool, "Drop": bool,
+    },
+}
+
+EVENT_NAMES = {
+    EVENT_TYPE_GUEST_REG: "GUEST_REG",
+    EVENT_TYPE_MEM_GUEST_DECL: "MEM_GUEST_DECL",
+    EVENT_TYPE_REMOTE_ACTIVITY: "REMOTE_ACTIVITY",
+}
+
+# Version and type prefix, packed once per event type.
+_HEADERS = {t: msgpack.packb(EVENT_VERSION) + msgpack.packb(t) for t in SCHEMAS}
+
+
+class InvalidEvent(ValueError):
+    pass
+
+
+def encode(event_type: int, payload: dict) -> bytes:
+    return _HEADERS[event_type] + msgpack.packb(payload)
+
+
+def guest_reg(guest_id: int, registering: bool, age: int, male: bool) -> bytes:
+    return encode(EVENT_TYPE_GUEST_REG, {"Guest_id": guest_id, "Registering": registering,
+                                         "Guest_age": age, "Guest_male": male})
+
+
+def declaration(member_keys: list, guest_keys: list, confidence: int=100) -> bytes:
+    return encode(EVENT_TYPE_MEM_GUEST_DECL, {"Member_Keys": member_keys, "Guests": guest_keys,
+                                              "Confidence": confidence})
+
+
+def remote_activity(absent, lock: bool=False, orr: bool=False, drop: bool=False) -> bytes:
+    return encode(EVENT_TYPE_REMOTE_ACTIVITY, {"Lock": lock, "ORR": orr,
+                                               "Absent_Key_Press": absent, "Drop": drop})
+
+
+def _check_type(name, value, kind):
+    if kind is bool:
+        # The absent flag comes from the DB as 0/1.
+        ok = isinstance(value, bool) or value in (0, 1)
+    elif kind is int:
+        ok = isinstance(value, int) and not isinstance(value, bool)
+    else:
+        ok = isinstance(value, kind)
+    if not ok:
+        raise InvalidEvent(f"{name} should be {kind.__name__}, got {value!r}")
+
+
+def validate(event_type: int, payload):
+    """
+    Check `payload` against the schema for `event_type`.
+    """
+    schema = SCHEMAS.get(event_type)
+    if schema is None:
+        raise InvalidEvent(f"Unknown event type {event_type!r}")
+    if not isinstance(payload, dict):
+        raise InvalidEvent(f"Payload should be a map, got {type(payload).__name__}")
+    if set(payload) != set(schema):
+        raise InvalidEvent(f"Fields {sorted(payload)} != {sorted(schema)}")
+    for name, kind in schema.items():
+        _check_type(name, payload[name], kind)
+
+    if event_type == EVENT_TYPE_GUEST_REG:
+        if not 0 <= payload["Guest_id"] < GUEST_KEYS:
+            raise InvalidEvent(f"Guest_id {payload['Guest_id']} out of range")
+        if payload["Guest_age"] < 0:
+            raise InvalidEvent(f"Guest_age {payload['Guest_age']} is negative")
+    elif event_type == EVENT_TYPE_MEM_GUEST_DECL:
+        for name, size in (("Member_Keys", MEMBER_KEYS), ("Guests", GUEST_KEYS)):
+            keys = payload[name]
+            if len(keys) != size or not all(isinstance(k, bool) for k in keys):
+                raise InvalidEvent(f"{name} should be {size} booleans, got {keys!r}")
+        if not 0 <= payload["Confidence"] <= 100:
+            raise InvalidEvent(f"Confidence {payload['Confidence']} out of range")
+
+
+def decode(frame: bytes):
+    """
+    Parse and validate one datagram. Returns (event type, payload).
+    """
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(frame)
+    try:
+        items = list(unpacker)
+    except Exception as e:
+        raise InvalidEvent(f"Bad msgpack data: {e}")
+    if len(items) != 3:
+        raise InvalidEvent(f"Expected 3 msgpack objects, got {len(items)}")
+    version, event_type, payload = items
+    if version != EVENT_VERSION:
+        raise InvalidEvent(f"Unsupported event version {version!r}")
+    validate(event_type, payload)
+    return event_type, payload
+
+
+class EventSender():
+    """
+    Datagram socket connected to `address`, reused across events and
+    reconnected once if the receiver went away.
+    """
+
+    def __init__(self, address: str):
+        self.address = address
+        self.sock = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def send(self, body: bytes):
+        try:
+            if self.sock is None:
+                self.connect()
+            self.sock.send(body)
+        except (ConnectionError, FileNotFoundError):
+            # remote-comm restarted and rebound the path; retry once.
+            self.close()
+            self.connect()
+            self.sock.send(body)
+
+    def send_batch(self, frames):
+        """
+        Send `frames` back to back over the one socket.
+        """
+        for body in frames:
+            self.send(body)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+_LENGTH = struct.Struct("<H")
+DEFAULT_PENDING_PATH = "/var/lib/remote/pending_events.bin"
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PendingBatch():
+    """
+    Frames that must all reach the receiver, kept in `path` until sent.
+    """
+
+    def __init__(self, path: str=DEFAULT_PENDING_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def save(self, frames):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"".join(_LENGTH.pack(len(body)) + body for body in frames))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        # The rename itself must reach the disk for the batch to survive
+        # a power loss.
+        _fsync_dir(self.path)
+
+    def load(self) -> list:
+        """
+        Frames of the unfinished batch, if any. A torn file means the
+        batch was never committed, and nothing of it was sent.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        frames = []
+        pos = 0
+        while pos + _LENGTH.size <= len(data):
+            size, = _LENGTH.unpack_from(data, pos)
+            pos += _LENGTH.size
+            if pos + size > len(data):
+                return []
+            frames.append(data[pos:pos + size])
+            pos += size
+        return frames if pos == len(data) else []
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
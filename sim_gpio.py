@@ -0,0 +1,119 @@
+"""
+Simulated RPi.GPIO for running the meter without a Pi.
+
+`SimulatedGPIO` exposes the subset of the RPi.GPIO module API the meter
+uses (setmode, setup, input, output, cleanup and the BOARD/IN/OUT/
+PUD_DOWN constants). Inputs registered with `pulse_train()` go high for
+`width` seconds at `rate` pulses per second, with each interval
+stretched or shrunk by up to `jitter` (a fraction of the period).
+Pulses are generated lazily from the wall clock, so whatever samples
+the pin sees exactly what a real input would, and `generated(pin)`
+tells how many pulses were produced so far.
+"""
+import random
+import threading
+import time
+
+BOARD = 10
+BCM = 11
+IN = 1
+OUT = 0
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+HIGH = 1
+LOW = 0
+
+
+class PulseTrain(object):
+
+    def __init__(self, rate, width=0.01, jitter=0.0, start=None, seed=None):
+        self.period = 1.0 / rate
+        self.width = min(width, self.period / 2)
+        self.jitter = jitter
+        self.rand = random.Random(seed)
+        self.current = None
+        self.next = (time.time() if start is None else start) + self._interval()
+        self.count = 0
+        self.times = []
+        self.keep_times = False
+
+    def _interval(self):
+        return self.period * (1 + self.jitter * self.rand.uniform(-1, 1))
+
+    def advance(self, now):
+        while self.next <= now:
+            self.current = self.next
+            self.count += 1
+            if self.keep_times:
+                self.times.append(self.current)
+            self.next = self.current + max(self._interval(), self.width * 2)
+
+    def level(self, now):
+        self.advance(now)
+        return 1 if self.current is not None and now < self.current + self.width else 0
+
+
+class SimulatedGPIO(object):
+
+    BOARD = BOARD
+    BCM = BCM
+    IN = IN
+    OUT = OUT
+    PUD_OFF = PUD_OFF
+    PUD_DOWN = PUD_DOWN
+    PUD_UP = PUD_UP
+    HIGH = HIGH
+    LOW = LOW
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.mode = None
+        self.directions = {}
+        self.outputs = {}
+        self.trains = {}
+        self.lock = threading.Lock()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=LOW):
+        self.directions[pin] = direction
+        if direction == OUT:
+            self.outputs[pin] = initial
+
+    def pulse_train(self, pin, rate, width=0.01, jitter=0.0, seed=None, keep_times=False):
+        """
+        Drive input `pin` with a pulse train starting now.
+        """
+        with self.lock:
+            train = PulseTrain(rate, width, jitter, start=self.clock(), seed=seed)
+            train.keep_times = keep_times
+            self.trains[pin] = train
+        return train
+
+    def input(self, pin):
+        train = self.trains.get(pin)
+        if train is None:
+            return self.outputs.get(pin, LOW)
+        with self.lock:
+            return train.level(self.clock())
+
+    def output(self, pin, value):
+        self.outputs[pin] = HIGH if value else LOW
+
+    def generated(self, pin):
+        train = self.trains.get(pin)
+        if train is None:
+            return 0
+        with self.lock:
+            train.advance(self.clock())
+            return train.count
+
+    def cleanup(self):
+        self.trains.clear()
+        self.outputs.clear()
+        self.directions.clear()
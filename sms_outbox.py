@@ -0,0 +1,188 @@
+"""
+Background SMS outbox for meter alerts.
+
+`Outbox.enqueue()` only records the message and returns; a worker thread
+sends it through `gsm_modem.Modem` so the pulse loop never waits on the
+serial port. Messages are
+
+  * deduplicated: a pending message with the same recipient and key is
+    updated in place instead of queued twice,
+  * rate limited: at most one message per recipient every
+    `min_interval` seconds,
+  * retried with exponential backoff up to `max_attempts`,
+  * persisted to `path` so pending alerts survive a restart.
+
+`Outbox.status(msg_id)` reports "pending", "sent" or "failed".
+"""
+import json
+import os
+import threading
+import time
+
+from gsm_modem import ModemError
+from meter_metrics import METRICS
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+# Finished messages kept around for status queries.
+KEEP_FINISHED = 50
+
+
+class Outbox(threading.Thread):
+
+    def __init__(self, modem, path="sms_outbox.json", min_interval=300,
+                 max_attempts=5, retry_delay=30, on_status=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.modem = modem
+        self.path = path
+        self.min_interval = min_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.on_status = on_status
+        self.cond = threading.Condition()
+        self.running = True
+        self.messages = []
+        self.last_sent = {}
+        self.next_id = 1
+        self.load()
+        METRICS.gauge("sms.outbox", self.pending)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ValueError:
+            print("Ignoring corrupt outbox %s" % self.path)
+            return
+        self.messages = data.get("messages", [])
+        self.last_sent = data.get("last_sent", {})
+        self.next_id = data.get("next_id", 1)
+
+    def save(self):
+        """
+        Atomically rewrite the outbox file. Caller holds `self.cond`.
+        """
+        finished = [m for m in self.messages if m["status"] != PENDING]
+        if len(finished) > KEEP_FINISHED:
+            drop = set(id(m) for m in finished[:-KEEP_FINISHED])
+            self.messages = [m for m in self.messages if id(m) not in drop]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"messages": self.messages, "last_sent": self.last_sent,
+                       "next_id": self.next_id}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+    def enqueue(self, number, text, key=None):
+        """
+        Queue `text` for `number` and return its message id. A pending
+        message with the same `key` (default: the text) for the same
+        number is refreshed with the new text instead.
+        """
+        key = key or text
+        with self.cond:
+            for m in self.messages:
+                if m["status"] == PENDING and m["number"] == number and m["key"] == key:
+                    m["text"] = text
+                    self.save()
+                    return m["id"]
+            msg = {
+                "id": self.next_id,
+                "number": number,
+                "text": text,
+                "key": key,
+                "status": PENDING,
+                "attempts": 0,
+                "next_try": 0,
+                "ref": None,
+                "created": time.time(),
+            }
+            self.next_id += 1
+            self.messages.append(msg)
+            self.save()
+            self.cond.notify()
+            return msg["id"]
+
+    def status(self, msg_id):
+        with self.cond:
+            for m in self.messages:
+                if m["id"] == msg_id:
+                    return m["status"]
+        return None
+
+    def pending(self):
+        with self.cond:
+            return sum(1 for m in self.messages if m["status"] == PENDING)
+
+    def _due(self, now):
+        """
+        Earliest message allowed to go out now, and the time the next one
+        becomes due. Caller holds `self.cond`.
+        """
+        wake = None
+        for m in self.messages:
+            if m["status"] != PENDING:
+                continue
+            at = max(m["next_try"], self.last_sent.get(m["number"], 0) + self.min_interval)
+            if at <= now:
+                return m, None
+            wake = at if wake is None else min(wake, at)
+        return None, wake
+
+    def due(self, now=None):
+        """
+        Next message to send now, or None and the time one becomes due.
+        For callers that drive `send_one()` instead of starting the
+        thread.
+        """
+        with self.cond:
+            return self._due(time.time() if now is None else now)
+
+    def _finish(self, msg, status):
+        msg["status"] = status
+        if self.on_status:
+            self.on_status(msg)
+
+    def send_one(self, msg):
+        try:
+            ref = self.modem.send_sms(msg["number"], msg["text"])
+        except (ModemError, IOError) as e:
+            print("SMS %d to %s failed: %s" % (msg["id"], msg["number"], e))
+            with self.cond:
+                msg["attempts"] += 1
+                if msg["attempts"] >= self.max_attempts:
+                    self._finish(msg, FAILED)
+                    METRICS.incr("sms.failed")
+                else:
+                    METRICS.incr("sms.retries")
+                    msg["next_try"] = time.time() + self.retry_delay * 2 ** (msg["attempts"] - 1)
+                self.save()
+            return False
+        with self.cond:
+            msg["attempts"] += 1
+            msg["ref"] = ref
+            self.last_sent[msg["number"]] = time.time()
+            self._finish(msg, SENT)
+            METRICS.incr("sms.sent")
+            self.save()
+        return True
+
+    def run(self):
+        while self.running:
+            with self.cond:
+                msg, wake = self._due(time.time())
+                if msg is None:
+                    self.cond.wait(None if wake is None else max(wake - time.time(), 0.01))
+                    continue
+            self.send_one(msg)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
@@ -1,21 +1,18 @@
 import copy
 import datetime
 import json
-import msgpack
 import os
 from pathlib import Path
 import subprocess
-import socket
 from shutil import which
 import time
 
 import db
 import display as dsp
+from member_config import MemberConfig
+import remote_events as events
+import state_snapshot
 
-EVENT_VERSION = 1
-EVENT_TYPE_GUEST_REG = 2
-EVENT_TYPE_MEM_GUEST_DECL = 3
-EVENT_TYPE_REMOTE_ACTIVITY = 25
 INSTALLATION_MODE_SENTINEL = "/run/installation_mode"
 
 # get the socket file
@@ -57,7 +54,7 @@ class State():
 
     def __init__(self):
         self.viewersDeclared = []
-        self.viewersRegistered = []
+        self.viewersRegistered = frozenset()
         self.guestsRegistered = []
         self.absent = None
         self.cleared_aud = None
@@ -154,42 +151,26 @@ class Remote(State):
         """
         self.viewersDeclared = []
         vd = self.dbi.loadDeclaration()
+        guests = self.registeredGuestPositions()
         for v in vd:
             if len(v) == 1 and v in self.viewersRegistered:
                 self.viewersDeclared.append(v)
-            elif len(v) == 2 and self.guest_reg(Guest(v[1:])):
+            elif len(v) == 2 and v[1:] in guests:
                 self.viewersDeclared.append(v)
         self.viewersDeclared.sort()
 
 
-    def defaultRegMembers(self):
-        """
-        Default registered members during installation mode
-        """
-        return [chr(65+i) for i in range(12)]
-
-
     def readMemberConfig(self):
         """
-        Get member config from OS
+        Get member config from OS, reparsed only when it changed
         """
+        if self.memberConfig.refresh(self.in_installation_mode):
+            dprint(f"Registered members: {self.memberConfig.ordered}")
+        return self.memberConfig.members
 
-        regs = []
-        member_info = subprocess.getoutput('get_config MEMBER_INFO')
-        if not member_info:
-            if self.in_installation_mode:
-                return self.defaultRegMembers() 
-            return regs
 
-        member_info = json.loads(member_info)
-        if not member_info:
-            if self.in_installation_mode:
-                return self.defaultRegMembers()
-            return regs
-
-        member_pos = sorted([int(k[1:]) for k in member_info.keys()])
-        regs = [chr(64+p) for p in member_pos]
-        return regs
+    def registeredGuestPositions(self):
+        return {g.position for g in self.guestsRegistered}
 
 
     def __init__(self):
@@ -198,6 +179,7 @@ class Remote(State):
         self.declareKeyMaps()
         self.dbi = db.DBInterface()
         self.cleared_aud = self.dbi.loadClearedAud()
+        self.memberConfig = MemberConfig(os.environ.get("MEMBER_CONFIG_PATH"))
         self.viewersRegistered  = self.readMemberConfig()
         self.loadGuestRegistration()
         self.loadDeclaration()
@@ -209,6 +191,14 @@ class Remote(State):
         self.in_installation_mode = self.dbi.loadInstallationModeState()
         self.refreshed_info_at = None
         self.last_known_key_press = None
+        self.eventSender = events.EventSender(socket_address)
+        self.pendingBatch = events.PendingBatch(os.environ.get("PENDING_EVENTS_PATH", events.DEFAULT_PENDING_PATH))
+        self.resendPendingBatch()
+        try:
+            self.snapshot = state_snapshot.SnapshotWriter(os.environ.get("STATE_SNAPSHOT", state_snapshot.DEFAULT_PATH))
+        except OSError as e:
+            print(f"State snapshot disabled: {e}")
+            self.snapshot = None
 
 
     def dbusNotify(self):
@@ -218,6 +208,17 @@ class Remote(State):
         )
 
 
+    def publishState(self):
+        """
+        Mirror the saved state into the shared-memory snapshot.
+        """
+        if self.snapshot is None:
+            return
+        self.snapshot.write(self.viewersRegistered, self.viewersDeclared,
+                            [(g.position, g.identity) for g in self.guestsRegistered],
+                            self.absent, self.tv, self.brightnessLevel, self.in_installation_mode)
+
+
     def saveState(self):
         self.dprintStates("Saving states")
         self.dbi.saveState(self.dbi.viewershipConn, 'declared_viewers', json.dumps(self.viewersDeclared))
@@ -227,6 +228,7 @@ class Remote(State):
         self.dbi.saveState(self.dbi.guestRegistrationConn, 'absent', int(self.absent))
         self.dbi.saveState(self.dbi.guestRegistrationConn, 'brightness_level', str(self.brightnessLevel))
         self.dbi.saveState(self.dbi.guestRegistrationConn, 'in_installation_mode', str(self.in_installation_mode))
+        self.publishState()
         self.dbusNotify()
         self.stateChangedAt=None
 
@@ -237,17 +239,20 @@ class Remote(State):
         self.saveState()
 
 
-    def clearGuestRegistration(self):
+    def clearGuestRegistration(self, batch):
+        """
+        Deregister all guests, adding the events to `batch`. The caller
+        commits the batch and saves state.
+        """
         dprint("Deregistering guests")
         for g in self.guestsRegistered:
             if "G"+g.position in self.viewersDeclared:
                 self.viewersDeclared.remove("G"+g.position)
         self.viewersDeclared.sort()
-        self.pushEvent()
+        self.pushEvent(batch=batch)
         for g in self.guestsRegistered:
-            self.pushEvent(deReg=g)
+            self.pushEvent(deReg=g, batch=batch)
         self.guestsRegistered = []
-        self.saveState()
 
 
     def moveToTVON(self):
@@ -303,11 +308,17 @@ class Remote(State):
 
 
     def onNewAud(self, current_aud):
+        """
+        Session rollover: pending state, the declaration without guests
+        and every guest deregistration go out as one batch, with a
+        single state save.
+        """
         if not self.tv:
-            self.checkEventGen(True)
-            self.clearGuestRegistration()
+            batch = []
+            self.pushEvent(batch=batch)
+            self.clearGuestRegistration(batch)
             self.cleared_aud = current_aud
-            self.saveState()
+            self.commitBatch(batch)
 
 
     def guest_reg(self, guest: Guest):
@@ -318,22 +329,52 @@ class Remote(State):
         return False
 
 
-    def sendEvent(self, body):
-        push_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        push_socket.connect(socket_address)
-        push_socket.sendall(body)
-        push_socket.close()
+    def sendEvent(self, body, batch=None):
+        if batch is not None:
+            batch.append(body)
+        elif self.batchPending:
+            # Older frames are still unsent; queue behind them so the
+            # receiver sees events in order.
+            self.pendingBatch.save(self.pendingBatch.load() + [body])
+            self.resendPendingBatch()
+        else:
+            self.eventSender.send(body)
+
+
+    def commitBatch(self, batch):
+        """
+        Journal `batch`, save state once, then send the batch in one
+        burst. A crash before the journal write leaves the old state and
+        nothing sent; after it, `resendPendingBatch()` finishes the send
+        on the next start.
+        """
+        frames = self.pendingBatch.load() + batch
+        if frames:
+            self.pendingBatch.save(frames)
+        self.saveState()
+        self.resendPendingBatch()
+
+
+    def resendPendingBatch(self):
+        frames = self.pendingBatch.load()
+        self.batchPending = bool(frames)
+        if not frames:
+            return
+        try:
+            self.eventSender.send_batch(frames)
+        except OSError as e:
+            print(f"Sending {len(frames)} pending events failed: {e}")
+            return
+        self.pendingBatch.clear()
+        self.batchPending = False
 
 
-    def pushEvent(self, toBeRegisteredGuest=None, deReg=None):
+    def pushEvent(self, toBeRegisteredGuest=None, deReg=None, batch=None):
         if toBeRegisteredGuest:
             # Registeration
             guest_id = int(toBeRegisteredGuest.position)-1
             guest_age = int(toBeRegisteredGuest.identity[1:])
-            body = msgpack.packb(EVENT_VERSION)+msgpack.packb(EVENT_TYPE_GUEST_REG)+\
-                msgpack.packb({"Guest_id": guest_id, "Registering": True, \
-                               "Guest_age": guest_age, \
-                               "Guest_male":toBeRegisteredGuest.identity[0]=="M"})
+            body = events.guest_reg(guest_id, True, guest_age, toBeRegisteredGuest.identity[0]=="M")
             dprint("Guest reg event body: ")
             dprint({"Guest_id": guest_id, "Registering": True, \
                            "Guest_age": guest_age, \
@@ -342,10 +383,7 @@ class Remote(State):
             # Guest De-Reg
             guest_id = int(deReg.position)-1
             guest_age = int(deReg.identity[1:])
-            body = msgpack.packb(EVENT_VERSION)+msgpack.packb(EVENT_TYPE_GUEST_REG)+\
-                msgpack.packb({"Guest_id": guest_id, "Registering": False, \
-                            "Guest_age": guest_age, \
-                            "Guest_male":deReg.identity[0]=="M"})
+            body = events.guest_reg(guest_id, False, guest_age, deReg.identity[0]=="M")
             dprint("Guest de-reg event body: ")
             dprint({"Guest_id": guest_id, "Registering": False, \
                         "Guest_age": guest_age, \
@@ -353,33 +391,33 @@ class Remote(State):
         else:
             # Declaration
             if self.lastCommState.viewersDeclared != self.viewersDeclared:
-                member_keys = [False]*12
-                guest_keys = [False]*5
+                member_keys = [False]*events.MEMBER_KEYS
+                guest_keys = [False]*events.GUEST_KEYS
                 for m in self.viewersDeclared:
                     if len(m) == 1:
                         member_keys[ord(m)-65] = True
                     elif len(m) == 2:
                         guest_keys[int(m[1:])-1] = True
-                body = msgpack.packb(EVENT_VERSION)+msgpack.packb(EVENT_TYPE_MEM_GUEST_DECL)+\
-                    msgpack.packb({"Member_Keys": member_keys, "Guests": guest_keys, "Confidence": 100})
+                body = events.declaration(member_keys, guest_keys)
                 dprint("Mem declaration event body: ")
                 dprint({"Member_Keys": member_keys, "Guests": guest_keys, "Confidence": 100})
-                self.sendEvent(body)
+                self.sendEvent(body, batch)
                 self.lastCommState.viewersDeclared = copy.deepcopy(self.viewersDeclared)
             if self.lastCommState.absent != self.absent:
-                body = msgpack.packb(EVENT_VERSION)+msgpack.packb(EVENT_TYPE_REMOTE_ACTIVITY)+\
-                    msgpack.packb({"Lock": False, "ORR": False, "Absent_Key_Press": self.absent, "Drop": False})
+                body = events.remote_activity(self.absent)
                 dprint("Remote state event body: ")
                 dprint({"Lock": False, "ORR": False, "Absent_Key_Press": self.absent, "Drop": False})
-                self.sendEvent(body)
+                self.sendEvent(body, batch)
                 self.lastCommState.absent = self.absent
             return
-        self.sendEvent(body)
+        self.sendEvent(body, batch)
 
 
     def checkEventGen(self, force: bool=False):
         if (self.stateChangedAt and datetime.datetime.now() - self.stateChangedAt > datetime.timedelta(seconds=20)) or force:
             self.saveState()
+            # Events left over from an interrupted batch go first.
+            self.resendPendingBatch()
             self.pushEvent()
 
 
@@ -393,7 +431,7 @@ class Remote(State):
     {where}
         Cleared audience session      : {self.cleared_aud},
         Declared viewers              : {self.viewersDeclared},
-        Registered members            : {self.viewersRegistered},
+        Registered members            : {sorted(self.viewersRegistered)},
         Registered guests             : {self.guestsRegistered},
         Absence                       : {self.absent},
         TV Status                     : {self.tv},
@@ -557,18 +595,20 @@ class DisplayHandler(Remote):
         elif self.grKeyPressTime is None:
             top_row = []
             bottom_row = []
+            declared = set(self.viewersDeclared)
+            guests = self.registeredGuestPositions()
             for i in range(65, 77):
                 c = chr(i)
-                if c in self.viewersRegistered and c not in self.viewersDeclared:
+                if c in self.viewersRegistered and c not in declared:
                     c = "_"
                 elif c not in self.viewersRegistered:
                     c = "."
                 top_row.append(c)
             for i in range(1, 6):
                 c = str(i)
-                if self.guest_reg(Guest(c)) and "G"+c not in self.viewersDeclared:
+                if c in guests and "G"+c not in declared:
                     c = "_"
-                elif not self.guest_reg(Guest(c)):
+                elif c not in guests:
                     c = "."
                 bottom_row.append(c)
             bottom_row.append(str(int(self.absent)))
@@ -0,0 +1,196 @@
+"""
+Memory-mapped snapshot of the remote handler's state.
+
+`Remote.saveState()` publishes the state it just saved through a
+`SnapshotWriter` to a small fixed-size file under /run. Other processes
+map the same file with `SnapshotReader` and poll it without touching
+sqlite or waiting on D-Bus:
+
+    reader = SnapshotReader()
+    if reader.changed():
+        snap = reader.read()
+        print(snap.declared, snap.absent, snap.tv)
+
+File layout, little endian:
+
+    header  magic "RSS1", layout u16, size u16, seq u32
+    body    updated_at f64, registered mask u32, declared mask u32,
+            guest mask u8, guest sexes 5s, guest ages 5 x u8,
+            absent u8, tv u8, brightness u8, installation mode u8
+    crc32   of the body, u32
+
+Viewer masks use bit 0-11 for members A-L and bit 12-16 for guests
+G1-G5. `seq` is a seqlock: the writer makes it odd, rewrites the body
+and makes it even again, and a reader only accepts a body when `seq`
+was even and unchanged around its copy and the CRC matches; Python
+gives no atomic or ordered stores, so the CRC is what rules out a torn
+body. The file is
+rewritten in place, never replaced, so readers can keep it mapped
+across writer restarts.
+"""
+import collections
+import mmap
+import os
+import struct
+import time
+import zlib
+
+DEFAULT_PATH = "/run/remote_state.snap"
+MAGIC = b"RSS1"
+LAYOUT = 1
+
+HEADER = struct.Struct("<4sHHI")
+BODY = struct.Struct("<dIIB5s5BBBBB")
+CRC = struct.Struct("<I")
+SEQ_OFFSET = 8
+SIZE = HEADER.size + BODY.size + CRC.size
+
+MEMBERS = 12
+GUESTS = 5
+
+Snapshot = collections.namedtuple("Snapshot", [
+    "seq", "updated_at", "registered", "declared", "declared_mask",
+    "guests", "absent", "tv", "brightness", "installation_mode",
+])
+
+
+class SnapshotError(RuntimeError):
+    pass
+
+
+def mask_from_viewers(viewers) -> int:
+    """
+    Bitmask for viewer names like "A" or "G2".
+    """
+    mask = 0
+    for v in viewers:
+        if len(v) == 1:
+            mask |= 1 << (ord(v) - 65)
+        else:
+            mask |= 1 << (MEMBERS + int(v[1:]) - 1)
+    return mask
+
+
+def viewers_from_mask(mask: int) -> list:
+    viewers = [chr(65 + i) for i in range(MEMBERS) if mask >> i & 1]
+    viewers += [f"G{i + 1}" for i in range(GUESTS) if mask >> (MEMBERS + i) & 1]
+    return viewers
+
+
+class SnapshotWriter():
+
+    def __init__(self, path: str=DEFAULT_PATH):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < SIZE:
+                os.ftruncate(fd, SIZE)
+            self.map = mmap.mmap(fd, SIZE)
+        finally:
+            os.close(fd)
+        magic, layout, size, seq = HEADER.unpack_from(self.map, 0)
+        if (magic, layout, size) != (MAGIC, LAYOUT, SIZE):
+            seq = 0
+            HEADER.pack_into(self.map, 0, MAGIC, LAYOUT, SIZE, seq)
+        # Resume from the last published sequence so readers never see
+        # it go back; a crash mid-write leaves it odd.
+        self.seq = seq + (seq & 1)
+
+    def write(self, registered, declared, guests, absent, tv, brightness, installation_mode):
+        """
+        Publish one state. `registered` and `declared` are viewer names,
+        `guests` (position, identity) pairs such as ("2", "M25").
+        """
+        guest_mask = 0
+        sexes = bytearray(GUESTS)
+        ages = [0] * GUESTS
+        for position, identity in guests:
+            slot = int(position) - 1
+            guest_mask |= 1 << slot
+            if identity:
+                sexes[slot] = ord(identity[0])
+                ages[slot] = min(int(identity[1:]), 255)
+        body = BODY.pack(time.time(), mask_from_viewers(registered), mask_from_viewers(declared),
+                         guest_mask, bytes(sexes), *ages, int(bool(absent)), int(bool(tv)),
+                         int(brightness) & 0xFF, int(bool(installation_mode)))
+
+        self.seq += 1
+        struct.pack_into("<I", self.map, SEQ_OFFSET, self.seq & 0xFFFFFFFF)
+        self.map[HEADER.size:SIZE] = body + CRC.pack(zlib.crc32(body) & 0xFFFFFFFF)
+        self.seq += 1
+        struct.pack_into("<I", self.map, SEQ_OFFSET, self.seq & 0xFFFFFFFF)
+
+    def close(self):
+        self.map.close()
+
+
+class SnapshotReader():
+
+    def __init__(self, path: str=DEFAULT_PATH):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), SIZE, access=mmap.ACCESS_READ)
+        magic, layout, size, _ = HEADER.unpack_from(self.map, 0)
+        if (magic, layout, size) != (MAGIC, LAYOUT, SIZE):
+            self.map.close()
+            raise SnapshotError(f"{path} is not a layout {LAYOUT} state snapshot")
+        self.last_seq = None
+
+    def seq(self) -> int:
+        return struct.unpack_from("<I", self.map, SEQ_OFFSET)[0]
+
+    def changed(self) -> bool:
+        """
+        True if a new state was published since the last `read()`.
+        """
+        seq = self.seq()
+        return seq != 0 and seq != self.last_seq
+
+    def read(self, retries: int=1000) -> Snapshot:
+        for attempt in range(retries):
+            if attempt:
+                # Let the writer finish its update.
+                time.sleep(0.0001 if attempt > 10 else 0)
+            before = self.seq()
+            # The seq word is not written atomically, so 0 may also be a
+            # torn read of a live counter.
+            if before == 0 or before & 1:
+                continue
+            data = self.map[HEADER.size:SIZE]
+            if self.seq() != before:
+                continue
+            body, crc = data[:BODY.size], CRC.unpack_from(data, BODY.size)[0]
+            if zlib.crc32(body) & 0xFFFFFFFF != crc:
+                continue
+            self.last_seq = before
+            return self._decode(before, body)
+        if self.seq() == 0:
+            raise SnapshotError(f"No state published to {self.path} yet")
+        raise SnapshotError(f"No consistent snapshot in {self.path} after {retries} tries")
+
+    def _decode(self, seq, body):
+        (updated_at, registered, declared, guest_mask, sexes, a1, a2, a3, a4, a5,
+         absent, tv, brightness, installation) = BODY.unpack(body)
+        ages = (a1, a2, a3, a4, a5)
+        guests = []
+        for slot in range(GUESTS):
+            if guest_mask >> slot & 1:
+                identity = f"{chr(sexes[slot])}{ages[slot]}" if sexes[slot] else None
+                guests.append((str(slot + 1), identity))
+        return Snapshot(seq, updated_at, viewers_from_mask(registered), viewers_from_mask(declared),
+                        declared, guests, bool(absent), bool(tv), brightness, bool(installation))
+
+    def wait(self, timeout: float=None, interval: float=0.05):
+        """
+        Poll until a new state is published. Returns it, or None on
+        timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.changed():
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(interval)
+        return self.read()
+
+    def close(self):
+        self.map.close()
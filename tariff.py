@@ -0,0 +1,140 @@
+"""
+Tariff engine for prepaid billing.
+
+A tariff is defined in config as
+
+    TARIFF = {
+        "units_per_pulse": 1,
+        "slabs": [[0, 5], [100, 7], [300, 9]],     # [from unit, rate per unit]
+        "tod": [["22:00", "06:00", 0.8],           # [start, end, multiplier]
+                ["18:00", "22:00", 1.2]],
+        "thresholds": [100, 50, 20],               # low balance alerts
+    }
+
+Slabs apply to the units consumed in the current calendar month. At
+load the slabs are turned into a cumulative cost table and the
+time-of-day bands into a 1440 entry per-minute multiplier table, so
+billing a batch of pulses is a walk over runs of equal multiplier with
+a bisect per run instead of a rate lookup per pulse.
+
+`Thresholds` tracks which alert levels a balance has crossed, firing
+each one once on the way down and re-arming it when the balance goes
+back above.
+"""
+from array import array
+from bisect import bisect_right
+import calendar
+import time
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def _minute(hhmm):
+    h, m = hhmm.split(":")
+    return int(h) * 60 + int(m)
+
+
+class Tariff(object):
+
+    def __init__(self, slabs, tod=None, units_per_pulse=1, thresholds=None):
+        slabs = sorted((int(start), float(rate)) for start, rate in slabs)
+        if not slabs or slabs[0][0] != 0:
+            raise ValueError("The first slab must start at unit 0")
+        if not isinstance(units_per_pulse, (int, float)) or units_per_pulse <= 0:
+            raise ValueError("units_per_pulse must be a positive number, got %r" % (units_per_pulse,))
+        self.units_per_pulse = units_per_pulse
+        self.thresholds = sorted(thresholds or [], reverse=True)
+
+        # cost of the first `starts[k]` units, per slab boundary
+        self.starts = [s for s, _ in slabs]
+        self.rates = [r for _, r in slabs]
+        self.base = [0.0]
+        for k in range(1, len(slabs)):
+            self.base.append(self.base[-1] + (self.starts[k] - self.starts[k - 1]) * self.rates[k - 1])
+
+        self.multiplier = array("d", [1.0] * MINUTES_PER_DAY)
+        for start, end, factor in tod or []:
+            m, end = _minute(start), _minute(end)
+            while m != end:
+                self.multiplier[m] = factor
+                m = (m + 1) % MINUTES_PER_DAY
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("slabs", [[0, 1]]), config.get("tod"),
+                   config.get("units_per_pulse", 1), config.get("thresholds"))
+
+    @classmethod
+    def flat(cls, rate, units_per_pulse=1, thresholds=None):
+        """
+        Fixed `rate` per pulse, the billing the scripts started with.
+        """
+        return cls([[0, float(rate) / units_per_pulse]], None, units_per_pulse, thresholds)
+
+    def cumulative(self, units):
+        """
+        Cost of the first `units` units of the month.
+        """
+        k = bisect_right(self.starts, units) - 1
+        return self.base[k] + (units - self.starts[k]) * self.rates[k]
+
+    def minute_of_day(self, ts):
+        t = time.localtime(ts)
+        return t.tm_hour * 60 + t.tm_min
+
+    def cost(self, used, pulses, stamps=None):
+        """
+        Cost of `pulses` pulses when `used` units were already consumed
+        this month. `stamps` holds one timestamp per pulse for
+        time-of-day rates; without it every pulse is billed at now.
+        """
+        step = self.units_per_pulse
+        if not stamps:
+            factor = self.multiplier[self.minute_of_day(time.time())]
+            return factor * (self.cumulative(used + pulses * step) - self.cumulative(used))
+        total = 0.0
+        run_start = 0
+        mult = self.multiplier
+        # Local time offset taken once per batch; minute of day is then
+        # plain arithmetic on each timestamp.
+        offset = calendar.timegm(time.localtime(stamps[0])) - int(stamps[0])
+        factor = mult[int(stamps[0] + offset) // 60 % MINUTES_PER_DAY]
+        for n in range(1, len(stamps) + 1):
+            if n < len(stamps):
+                f = mult[int(stamps[n] + offset) // 60 % MINUTES_PER_DAY]
+                if f == factor:
+                    continue
+            lo = used + run_start * step
+            hi = used + n * step
+            total += factor * (self.cumulative(hi) - self.cumulative(lo))
+            if n < len(stamps):
+                run_start = n
+                factor = f
+        return total
+
+
+class Thresholds(object):
+    """
+    Per-meter alert levels; `level[i]` is how many thresholds meter `i`
+    is currently below.
+    """
+
+    def __init__(self, thresholds, meters):
+        self.thresholds = sorted(thresholds, reverse=True)
+        self.level = array("b", [0] * meters)
+
+    def update(self, i, balance):
+        """
+        Move meter `i` to `balance` and return the thresholds newly
+        crossed on the way down.
+        """
+        t = self.thresholds
+        level = self.level[i]
+        crossed = []
+        while level < len(t) and balance < t[level]:
+            crossed.append(t[level])
+            level += 1
+        while level > 0 and balance > t[level - 1]:
+            level -= 1
+        self.level[i] = level
+        return crossed
@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def wait_until(predicate, timeout=2.0, interval=0.01):
+    """
+    Poll `predicate` until it is true or `timeout` seconds pass.
+    """
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+@pytest.fixture
+def fake_modem():
+    from fake_modem import FakeModem
+    fm = FakeModem()
+    fm.start()
+    yield fm
+    fm.stop()
+
+
+@pytest.fixture
+def modem(fake_modem):
+    import gsm_modem
+    return gsm_modem.Modem(fake_modem.open_port())
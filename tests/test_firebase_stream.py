@@ -0,0 +1,74 @@
+import pytest
+
+import fake_firebase
+import firebase_stream
+import prepaid_meter
+from firebase_rest import RestClient
+
+from conftest import wait_until
+
+METERS = {"a": {"pin": 1, "path": "/A"}, "b": {"pin": 3, "path": "/B"}}
+
+
+@pytest.fixture
+def cloud():
+    fb = fake_firebase.FakeFirebase({"A": {"Balance": 100}, "B": {"Balance": 300}},
+                                    keepalive=0.5).start()
+    yield fb
+    fb.stop()
+
+
+@pytest.fixture
+def engine(cloud):
+    e = prepaid_meter.MeterEngine(METERS, None, RestClient(cloud.url))
+    e.load()
+    return e
+
+
+@pytest.fixture
+def stream(cloud, engine, monkeypatch):
+    monkeypatch.setattr(firebase_stream, "RECONNECT_MIN", 0.05)
+    st = firebase_stream.BalanceStream(cloud.url, engine)
+    st.start()
+    assert wait_until(lambda: engine.streaming)
+    yield st
+    st.stop()
+    st.join(2.0)
+
+
+def test_parse_events():
+    lines = [b"event: put\n", b'data: {"path": "/", "data": 1}\n', b"\n",
+             b": comment\n", b"event: keep-alive\n", b"data: null\n", b"\n"]
+    assert list(firebase_stream.parse_events(lines)) == [
+        ("put", '{"path": "/", "data": 1}'), ("keep-alive", "null")]
+
+
+def test_top_up_is_added(cloud, engine, stream):
+    client = RestClient(cloud.url)
+    engine.bill(0, 2)
+    client.put("/A", "Balance", 600)
+    assert wait_until(lambda: engine.balances[0] == 590)
+    client.patch("/", {"B/Balance": 350})
+    assert wait_until(lambda: engine.balances[1] == 350)
+    engine.sync()
+    assert cloud.tree.data["A"]["Balance"] == 590
+
+
+def test_own_writes_are_not_merged_again(cloud, engine, stream):
+    for _ in range(3):
+        engine.bill(0)
+        engine.sync()
+    assert wait_until(lambda: not engine.echoes[0])
+    assert list(engine.balances) == [85, 300]
+    assert not engine.dirty
+    assert cloud.tree.data["A"]["Balance"] == 85
+    # Syncing while streaming does not poll the cloud.
+    assert cloud.requests.get("GET", 0) == 2
+
+
+def test_reconnects_after_drop(cloud, engine, stream):
+    cloud.drop_streams()
+    assert wait_until(lambda: stream.reconnects == 1)
+    assert wait_until(lambda: engine.streaming)
+    RestClient(cloud.url).put("/B", "Balance", 500)
+    assert wait_until(lambda: engine.balances[1] == 500)
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+import gsm_modem
+from gsm_modem import ModemError, ModemTimeout
+
+
+def test_init_turns_echo_off_and_selects_text_mode(fake_modem, modem):
+    modem.init()
+    assert fake_modem.commands == ["AT", "ATE0", "AT+CMGF=1", "AT+CNMI=2,1,0,0,0"]
+    assert not fake_modem.echo
+
+
+def test_command_drops_the_echo(fake_modem, modem):
+    assert fake_modem.echo
+    assert modem.command("AT") == []
+
+
+def test_send_sms(fake_modem, modem):
+    modem.init()
+    assert modem.send_sms("+919665916383", "Balance 100") == 1
+    assert modem.send_sms("+919665916383", "Balance 95") == 2
+    assert fake_modem.sent == [("+919665916383", "Balance 100"), ("+919665916383", "Balance 95")]
+
+
+def test_error_codes_raise(fake_modem, modem):
+    modem.init()
+    fake_modem.fail_next.append("+CMS ERROR: 500")
+    with pytest.raises(ModemError) as info:
+        modem.send_sms("+919665916383", "x")
+    assert info.value.code == "+CMS ERROR: 500"
+    fake_modem.fail_next.append("ERROR")
+    with pytest.raises(ModemError) as info:
+        modem.command("AT+CMGD=1")
+    assert info.value.code == "ERROR"
+    assert fake_modem.sent == []
+    # The modem is still usable afterwards.
+    assert modem.command("AT") == []
+
+
+def test_timeout(fake_modem, modem):
+    modem.init()
+    fake_modem.silent_next = 1
+    start = time.time()
+    with pytest.raises(ModemTimeout):
+        modem.command("AT", timeout=0.2)
+    assert time.time() - start < 1.0
+    assert modem.command("AT") == []
+
+
+def test_prompt_timeout_leaves_text_entry(fake_modem, modem, monkeypatch):
+    modem.init()
+    monkeypatch.setattr(gsm_modem, "DEFAULT_TIMEOUT", 0.1)
+    fake_modem.delay = 0.5
+    with pytest.raises(ModemTimeout):
+        modem.send_sms("+919665916383", "late prompt")
+    fake_modem.delay = 0
+    # The late prompt was cancelled with ESC rather than taking the
+    # next command as message text.
+    time.sleep(0.6)
+    modem.poll()
+    assert modem.command("AT") == []
+    assert fake_modem.sent == []
+
+
+def test_urcs_are_queued(fake_modem, modem):
+    modem.init()
+    fake_modem.inject_sms("+919665916383", "*#*#100#*#*")
+    assert modem.poll(1.0) == 1
+    assert modem.urcs.popleft() == '+CMTI: "SM",1'
+    lines = modem.command("AT+CMGR=1")
+    assert lines[0].startswith('+CMGR: "REC UNREAD","+919665916383"')
+    assert lines[1] == "*#*#100#*#*"
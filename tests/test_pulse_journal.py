@@ -0,0 +1,87 @@
+import pytest
+
+import fake_firebase
+import prepaid_meter
+from firebase_rest import RestClient
+from pulse_journal import PulseJournal
+
+METERS = {"a": {"pin": 1, "path": "/A"}}
+
+
+@pytest.fixture
+def cloud():
+    fb = fake_firebase.FakeFirebase({"A": {"Balance": 100}}).start()
+    yield fb
+    fb.stop()
+
+
+def engine(cloud, path):
+    e = prepaid_meter.MeterEngine(METERS, None, RestClient(cloud.url), journal=PulseJournal(path))
+    e.load()
+    return e
+
+
+def test_records_survive_reopen(tmp_path):
+    path = str(tmp_path / "pulses.bin")
+    journal = PulseJournal(path)
+    for k in range(3):
+        journal.append(0, 1, ts=1000.0 + k)
+    journal.close()
+    journal = PulseJournal(path)
+    assert journal.seq == 3
+    assert [(seq, ts) for seq, ts, _, _ in journal.unsynced()] == [(1, 1000.0), (2, 1001.0), (3, 1002.0)]
+    journal.ack(2)
+    assert [r[0] for r in PulseJournal(path).unsynced()] == [3]
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    path = str(tmp_path / "pulses.bin")
+    journal = PulseJournal(path)
+    journal.append(0, 1)
+    journal.append(0, 1)
+    journal.close()
+    with open(path, "ab") as f:
+        f.write(b"\x00" * 5)
+    assert len(PulseJournal(path).unsynced()) == 2
+
+
+def test_replay_bills_unsynced_pulses_once(cloud, tmp_path):
+    path = str(tmp_path / "pulses.bin")
+    e = engine(cloud, path)
+    cloud.down = True
+    for _ in range(3):
+        e.bill(0)
+    with pytest.raises(IOError):
+        e.sync()
+    e.journal.close()
+
+    # Restart while the cloud is still behind.
+    cloud.down = False
+    e = engine(cloud, path)
+    assert e.balances[0] == 85
+    assert e.replay() == 0
+    assert e.balances[0] == 85
+    e.sync()
+    assert cloud.tree.data["A"]["Balance"] == 85
+    e.journal.close()
+
+    e = engine(cloud, path)
+    assert e.balances[0] == 85
+    assert e.replay() == 0
+
+
+def test_replay_skips_pulses_the_cloud_has(cloud, tmp_path, monkeypatch):
+    path = str(tmp_path / "pulses.bin")
+    e = engine(cloud, path)
+    e.bill(0)
+    e.bill(0)
+    # Crash between the PATCH and writing the ack.
+    monkeypatch.setattr(e.journal, "ack", lambda seq: None)
+    e.sync()
+    e.journal.close()
+    assert cloud.tree.data["A"]["Balance"] == 90
+
+    e = engine(cloud, path)
+    assert len(e.journal.unsynced()) == 2
+    assert e.balances[0] == 90
+    assert not e.dirty
@@ -0,0 +1,53 @@
+import pytest
+
+from recharge_sms import RechargeIngester, extract_tokens, parse_cmti
+
+from conftest import wait_until
+
+OWNER = "+919665916383"
+
+
+@pytest.fixture
+def ingester(modem, tmp_path):
+    modem.init()
+    tokens = []
+    ing = RechargeIngester(modem, lambda value, sender: tokens.append((value, sender)),
+                           path=str(tmp_path / "applied.json"),
+                           allowed_senders=["9665916383"], poll_interval=0.05)
+    ing.tokens = tokens
+    return ing
+
+
+def test_parsing():
+    assert parse_cmti('+CMTI: "SM",12') == 12
+    assert parse_cmti("RING") is None
+    assert extract_tokens("pay *#*#100#*#* and *#*#0#*#* *#*#25#*#*") == [100, 25]
+
+
+def test_backlog_is_applied_and_deleted(fake_modem, ingester):
+    fake_modem.inject_sms(OWNER, "*#*#100#*#*", notify=False)
+    fake_modem.inject_sms("+911111111111", "*#*#500#*#*", notify=False)
+    fake_modem.inject_sms(OWNER, "hello", notify=False)
+    assert ingester.process_backlog() == 3
+    assert ingester.tokens == [(100, OWNER)]
+    assert fake_modem.inbox == {}
+    assert [c for c in fake_modem.commands if c.startswith("AT+CMGL")] == ['AT+CMGL="ALL"']
+
+
+def test_cmti_fetches_the_message(fake_modem, ingester):
+    ingester.start()
+    try:
+        fake_modem.inject_sms(OWNER, "*#*#250#*#*")
+        assert wait_until(lambda: ingester.tokens)
+        assert ingester.tokens == [(250, OWNER)]
+        assert wait_until(lambda: not fake_modem.inbox)
+    finally:
+        ingester.stop()
+        ingester.join(1.0)
+
+
+def test_replayed_message_is_ignored(fake_modem, ingester):
+    fake_modem.inject_sms(OWNER, "*#*#100#*#*", notify=False)
+    fake_modem.inbox[2] = dict(fake_modem.inbox[1])
+    ingester.process_backlog()
+    assert ingester.tokens == [(100, OWNER)]
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+pytest.importorskip("msgpack")
+
+import remote_events as events
+from push_receiver import PushReceiver
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    r = PushReceiver(str(tmp_path / "push.sock"), keep=20)
+    r.start()
+    yield r
+    r.stop()
+
+
+def test_round_trip(receiver):
+    frames = [
+        events.guest_reg(3, True, 30, False),
+        events.declaration([False] * events.MEMBER_KEYS, [True] * events.GUEST_KEYS, 80),
+        events.remote_activity(True, lock=True),
+    ]
+    events.EventSender(receiver.address).send_batch(frames)
+    assert receiver.wait_for(3)
+    assert list(receiver.events) == [events.decode(f) for f in frames]
+    assert [t for t, _ in receiver.events] == [
+        events.EVENT_TYPE_GUEST_REG, events.EVENT_TYPE_MEM_GUEST_DECL,
+        events.EVENT_TYPE_REMOTE_ACTIVITY]
+    assert receiver.stats()["invalid"] == 0
+
+
+def test_invalid_frames_are_counted(receiver):
+    sender = events.EventSender(receiver.address)
+    sender.send(b"\x01\x02")
+    sender.send(events.encode(events.EVENT_TYPE_GUEST_REG, {"Guest_id": 1}))
+    assert receiver.wait_for(2)
+    assert receiver.stats()["invalid"] == 2
+    with pytest.raises(events.InvalidEvent):
+        events.decode(b"\x01\x02")
+
+
+def test_pending_batch(tmp_path):
+    batch = events.PendingBatch(str(tmp_path / "spool" / "pending.bin"))
+    assert batch.load() == []
+    frames = [events.guest_reg(i, False, 20 + i, True) for i in range(5)]
+    batch.save(frames)
+    assert batch.load() == frames
+    batch.clear()
+    assert batch.load() == []
+    assert not os.path.exists(batch.path)
+
+
+def test_torn_pending_batch_is_discarded(tmp_path):
+    batch = events.PendingBatch(str(tmp_path / "pending.bin"))
+    batch.save([events.remote_activity(False)] * 3)
+    with open(batch.path, "rb") as f:
+        data = f.read()
+    with open(batch.path, "wb") as f:
+        f.write(data[:-2])
+    assert batch.load() == []
+
+
+def test_pending_batch_is_sent_once_the_receiver_is_back(tmp_path):
+    address = str(tmp_path / "push.sock")
+    batch = events.PendingBatch(str(tmp_path / "pending.bin"))
+    frames = [events.guest_reg(i, True, 30, True) for i in range(3)]
+    batch.save(frames)
+    sender = events.EventSender(address)
+    with pytest.raises(OSError):
+        sender.send_batch(batch.load())
+    r = PushReceiver(address, keep=10)
+    r.start()
+    try:
+        sender.send_batch(batch.load())
+        batch.clear()
+        assert r.wait_for(3)
+        assert r.stats()["received"] == 3
+    finally:
+        r.stop()